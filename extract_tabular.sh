@@ -5,6 +5,14 @@
 # Make sure you're logged in to huggingface before running, if you're not sure
 # you should login using "huggingface-cli login" before running this script
 
+# To split the corpus across several nodes submit it as an array job, e.g.
+#   qsub -t 1-4 -v NUM_SHARDS=4 extract_tabular.sh
+# each task extracts its own shard and can be resubmitted on its own if it gets killed,
+# e.g. qsub -t 3 -v NUM_SHARDS=4 extract_tabular.sh reruns only the third shard.
+# Once all tasks are done, run
+#   uv run src/merge_shards.py
+# to check that every report was extracted exactly once.
+
 # Requesting resources from SCC
 #$ -P vkolagrp
 #$ -l h_rt=24:00:00
@@ -13,8 +21,8 @@
 #$ -l gpus=2
 #$-l gpu_c=8 # GPU capability, must be at least 8 for this project
 # -l gpu_type=H200 
-#$ -e logs/$JOB_ID.stderr
-#$ -o logs/$JOB_ID.stdout
+#$ -e logs/$JOB_ID.$TASK_ID.stderr
+#$ -o logs/$JOB_ID.$TASK_ID.stdout
 
 set -e
 
@@ -0,0 +1,291 @@
+# Inference backends of extract_tabular.py, selected with extraction.backend in config.yaml:
+#
+#   vllm    load the model in this process with vLLM (needs the GPUs)
+#   openai  send the prompts to an OpenAI-compatible server, e.g. vllm serve or stub_openai_server.py
+#   replay  answer with outputs recorded by an earlier run (extraction.record_path), CPU only
+#
+# Every backend turns a prompt into a Prompt with prepare() (tokenizing it if the backend
+# can), and a batch of Prompts into Completions with generate(). A Prompt can ask for several
+# samples in the same request, which share the prefill of the prompt. vLLM is only imported by
+# the vllm backend, so the other two start in a fraction of the time.
+#
+# Recordings are JSONL, one line per prompt: {"prompt": sha256 of the prompt text, "text",
+# "output_tokens", "finish_reason"}, and "texts" with every sample if there were more than one. The replay backend answers prompts it has no recording
+# for with an all-null Report, so that the pipeline can run end to end without recordings.
+
+import asyncio
+import hashlib
+import json
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from nbse_report_schema_minimal import Report
+
+
+@dataclass
+class Prompt:
+    text: str
+    # chat-formatted token ids, only if the backend has a tokenizer
+    token_ids: list[int] | None
+    n_tokens: int
+    # JSON schema to constrain the output to, if not the one the backend was built with
+    schema: dict | None = None
+    # number of samples to draw
+    n: int = 1
+
+
+@dataclass
+class Completion:
+    # None if the request failed
+    text: str | None
+    prompt_tokens: int
+    output_tokens: int
+    # "length" if the output was cut at max_tokens
+    finish_reason: str | None
+    # seconds from the request to the last token and to the first token, measured on the
+    # streamed response with the openai backend. Unknown with vllm, whose V1 engine does not
+    # record them offline (the batch wall time is in the metrics of extract_tabular.py)
+    latency: float | None = None
+    time_to_first_token: float | None = None
+    # every sample if the prompt asked for more than one, text is the first.
+    # Token counts are summed over the samples, finish_reason is "length" if any was cut.
+    texts: list[str] | None = None
+
+
+def finish_reason_of(reasons: list[str | None]) -> str | None:
+    return "length" if "length" in reasons else reasons[0]
+
+
+def prompt_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def estimate_tokens(text: str) -> int:
+    # about 4 characters per token in English, for backends without a tokenizer
+    return len(text) // 4 + 1
+
+
+class VLLMBackend:
+    """The model loaded in this process, prompts are tokenized here and sent as token ids."""
+
+    def __init__(self, model: str, sampling: dict, schema: dict, **llm_kwargs):
+        from vllm import LLM
+
+        self.llm = LLM(model=model, **llm_kwargs)
+        self.tokenizer = self.llm.get_tokenizer()
+        self.sampling = sampling
+        self.schema = schema
+        self.sampling_params = self.make_sampling_params(sampling, schema)
+        # sampling parameters of the prompts with their own schema or number of samples
+        self.custom_params = {}
+
+    @staticmethod
+    def make_sampling_params(sampling: dict, schema: dict, n: int = 1):
+        """Build the vLLM sampling parameters, constraining the output to the schema if requested."""
+        from vllm import SamplingParams
+        from vllm.sampling_params import GuidedDecodingParams
+
+        params = {k: v for k, v in sampling.items() if k != "guided_decoding"}
+        params["n"] = n
+
+        if sampling["guided_decoding"]:
+            params["guided_decoding"] = GuidedDecodingParams(json=schema)
+
+        return SamplingParams(**params)
+
+    def prepare(self, text: str, schema: dict | None = None) -> Prompt:
+        messages = [{"role": "user", "content": text}]
+
+        token_ids = self.tokenizer.apply_chat_template(
+            messages, tokenize=True, add_generation_prompt=True, enable_thinking=False
+        )
+
+        return Prompt(text, token_ids, len(token_ids), schema)
+
+    def params_for(self, prompt: Prompt):
+        if prompt.schema is None and prompt.n == 1:
+            return self.sampling_params
+
+        schema = prompt.schema if prompt.schema is not None else self.schema
+        key = (json.dumps(schema, sort_keys=True), prompt.n)
+        if key not in self.custom_params:
+            self.custom_params[key] = self.make_sampling_params(self.sampling, schema, prompt.n)
+
+        return self.custom_params[key]
+
+    def generate(self, prompts: list[Prompt]) -> list[Completion]:
+        from vllm.inputs import TokensPrompt
+
+        outputs = self.llm.generate(
+            [TokensPrompt(prompt_token_ids=prompt.token_ids) for prompt in prompts],
+            [self.params_for(prompt) for prompt in prompts],
+        )
+
+        return [
+            Completion(
+                output.outputs[0].text.strip(),
+                len(output.prompt_token_ids),
+                sum(len(sample.token_ids) for sample in output.outputs),
+                finish_reason_of([sample.finish_reason for sample in output.outputs]),
+                texts=[sample.text.strip() for sample in output.outputs] if len(output.outputs) > 1 else None,
+            )
+            for output in outputs
+        ]
+
+
+class OpenAIBackend:
+    """A running OpenAI-compatible server, with at most max_in_flight requests open at a time."""
+
+    def __init__(self, model: str, sampling: dict, schema: dict, server_url: str, max_in_flight: int):
+        self.model = model
+        self.sampling = sampling
+        self.schema = schema
+        self.server_url = server_url
+        self.max_in_flight = max_in_flight
+
+    def client(self):
+        from openai import AsyncOpenAI
+
+        return AsyncOpenAI(base_url=self.server_url, api_key="EMPTY")
+
+    async def complete(self, client, text: str, schema: dict | None = None, n: int = 1) -> Completion:
+        """Send one prompt to the server, constrained to schema if given, else to the backend schema."""
+        extra_body = {
+            "top_k": self.sampling["top_k"],
+            "chat_template_kwargs": {"enable_thinking": False},
+        }
+
+        if self.sampling["guided_decoding"]:
+            extra_body["guided_json"] = schema if schema is not None else self.schema
+
+        start = time.perf_counter()
+
+        # streamed, to time the first token
+        stream = await client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": text}],
+            temperature=self.sampling["temperature"],
+            top_p=self.sampling["top_p"],
+            max_tokens=self.sampling["max_tokens"],
+            n=n,
+            stream=True,
+            stream_options={"include_usage": True},
+            extra_body=extra_body,
+        )
+
+        contents = [""] * n
+        reasons = [None] * n
+        usage = None
+        first_token = None
+
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    contents[choice.index] += choice.delta.content
+
+                if choice.finish_reason is not None:
+                    reasons[choice.index] = choice.finish_reason
+
+        end = time.perf_counter()
+        texts = [content.strip() for content in contents]
+
+        return Completion(
+            texts[0],
+            usage.prompt_tokens if usage else estimate_tokens(text),
+            usage.completion_tokens if usage else 0,
+            finish_reason_of(reasons),
+            latency=end - start,
+            time_to_first_token=first_token - start if first_token is not None else None,
+            texts=texts if n > 1 else None,
+        )
+
+    def prepare(self, text: str, schema: dict | None = None) -> Prompt:
+        return Prompt(text, None, estimate_tokens(text), schema)
+
+    async def generate_async(self, prompts: list[Prompt]) -> list[Completion]:
+        client = self.client()
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        async def one(prompt: Prompt) -> Completion:
+            async with semaphore:
+                try:
+                    return await self.complete(client, prompt.text, prompt.schema, prompt.n)
+                except Exception as e:
+                    print(f"Request failed: {e}")
+                    return Completion(None, prompt.n_tokens, 0, "error")
+
+        try:
+            return await asyncio.gather(*(one(prompt) for prompt in prompts))
+        finally:
+            await client.close()
+
+    def generate(self, prompts: list[Prompt]) -> list[Completion]:
+        return asyncio.run(self.generate_async(prompts))
+
+
+class ReplayBackend:
+    """Recorded outputs, looked up by the hash of the prompt. Deterministic and CPU only."""
+
+    def __init__(self, replay_path: str | None):
+        self.recordings = {}
+        self.misses = 0
+
+        if replay_path is not None and Path(replay_path).exists():
+            with open(replay_path, encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.recordings[entry["prompt"]] = entry
+
+        self.default = json.dumps({name: None for name in Report.model_fields})
+
+    def prepare(self, text: str, schema: dict | None = None) -> Prompt:
+        return Prompt(text, None, estimate_tokens(text), schema)
+
+    def generate(self, prompts: list[Prompt]) -> list[Completion]:
+        completions = []
+
+        for prompt in prompts:
+            entry = self.recordings.get(prompt_digest(prompt.text))
+
+            if entry is None:
+                self.misses += 1
+                entry = {"text": self.default, "output_tokens": estimate_tokens(self.default), "finish_reason": "stop"}
+
+            # as many samples as asked for, repeating the recorded ones if there are fewer
+            recorded = entry.get("texts", [entry["text"]])
+            texts = [recorded[i % len(recorded)] for i in range(prompt.n)]
+
+            completions.append(
+                Completion(
+                    texts[0],
+                    prompt.n_tokens,
+                    entry["output_tokens"] * prompt.n // len(recorded),
+                    entry["finish_reason"],
+                    texts=texts if prompt.n > 1 else None,
+                )
+            )
+
+        return completions
+
+
+def record(path: Path, prompts: list[Prompt], completions: list[Completion]):
+    """Append the outputs of a batch to a recording, for the replay backend."""
+    with open(path, "a", encoding="utf-8") as f:
+        for prompt, completion in zip(prompts, completions):
+            if completion.text is None:
+                continue
+            entry = {
+                "prompt": prompt_digest(prompt.text),
+                "text": completion.text,
+                "output_tokens": completion.output_tokens,
+                "finish_reason": completion.finish_reason,
+            }
+            if completion.texts is not None:
+                entry["texts"] = completion.texts
+            f.write(json.dumps(entry) + "\n")
@@ -0,0 +1,272 @@
+# Extraction accuracy benchmark: which model/configuration to use for extract_tabular.py.
+#
+# A fixed held-out subset of the reports (those of a fraction of the patients in the
+# clinical spreadsheet, picked by a stable hash of the VAC) is extracted once per variant
+# in config.yaml (benchmark.variants), each variant in its own directory and in its own
+# process, so that vLLM releases the GPUs between variants. Extractions are resumable like
+# any other run of extract_tabular.py: re-running the benchmark only extracts what is missing.
+#
+# Every variant is then scored on the same reports:
+#   fields.parquet   per field: null rate over the reports with a usable output, and
+#                    accuracy against the spreadsheet where the spreadsheet has the same
+#                    information (see comparisons below), over every report of the subset
+#                    with a spreadsheet value: a report without a usable output counts as
+#                    wrong. coverage is the fraction of those with one
+#   summary.parquet  per variant: schema failure rate (output that could not be parsed into
+#                    a JSON object), field error rate (reports with at least one invalid
+#                    field), reports/s, tokens/s and GPU-hours per 1000 reports of the
+#                    extraction run
+#
+# Needs GPUs, submit it like extract_tabular.sh:
+#   uv run src/benchmark.py                       # extract with every variant, then score
+#   uv run src/benchmark.py --variants qwen3-8b-guided --score-only
+
+import argparse
+import hashlib
+from collections import Counter
+from pathlib import Path
+
+import polars as pl
+from omegaconf import OmegaConf
+
+import extract_tabular
+import json_to_tabular
+import outputs
+from clinical_spreadsheet import leading_int, load_clinical
+from config import config
+from nbse_report_schema_minimal import Report
+from report_files import extract_id
+
+benchmark_dir = Path(config.benchmark.dir)
+subset_dir = benchmark_dir / "txt"
+
+
+def coarse_diagnosis(col: str) -> pl.Expr:
+    """Diagnosis in the categories of the spreadsheet: Unimpaired, SCD, MCI, Dementia."""
+    text = pl.col(col).cast(pl.String).str.to_lowercase()
+    return (
+        pl.when(text.str.contains("dementia")).then(pl.lit("Dementia"))
+        .when(text.str.contains("mci|mild cognitive")).then(pl.lit("MCI"))
+        .when(text.str.contains("scd|subjective")).then(pl.lit("SCD"))
+        .when(text.str.contains("normal|unimpaired")).then(pl.lit("Unimpaired"))
+    )
+
+
+# extracted field -> (extracted value, spreadsheet values, tolerance)
+# The spreadsheet does not say which visit a report belongs to, so a score is correct if it
+# matches any visit. With a tolerance numbers are compared by absolute difference, otherwise
+# values must be equal. Spreadsheet columns are prefixed with "truth_" in these expressions.
+comparisons = {
+    # age at the first consult, the report can be from a later visit
+    "age": (pl.col("age"), [pl.col("truth_age_at_consult")], 1),
+    "sex": (
+        pl.col("sex").str.to_uppercase().str.slice(0, 1),
+        [pl.col("truth_sex").cast(pl.String).str.slice(0, 1)],
+        None,
+    ),
+    "education": (pl.col("education"), [pl.col("truth_education_years")], 0),
+    "moca_total_score": (
+        pl.col("moca_total_score"),
+        [leading_int(f"truth_moca_{i}") for i in range(1, 7)],
+        0,
+    ),
+    "diagnosis": (
+        coarse_diagnosis("diagnosis"),
+        [pl.col(f"truth_cognitive_syndrome_{i}").cast(pl.String) for i in range(1, 7)],
+        None,
+    ),
+    # amyloid PET recommended in the report vs. ordered according to the spreadsheet
+    "pet_recommended": (pl.col("pet_recommended"), [pl.col("truth_apet_code") == 1], None),
+}
+
+
+def held_out(vac: int) -> bool:
+    digest = hashlib.sha256(f"benchmark-{vac}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % 10_000 < config.benchmark.fraction * 10_000
+
+
+def make_subset(clinical: pl.DataFrame) -> list[Path]:
+    """Link the reports of the held-out patients into subset_dir, return the links."""
+    vacs = set(clinical["VAC"].drop_nulls().to_list())
+
+    subset_dir.mkdir(parents=True, exist_ok=True)
+    for link in subset_dir.glob("*.txt"):
+        link.unlink()
+
+    links = []
+    for txt_file in sorted(Path(config.paths.txt_dir).glob("*.txt")):
+        vac = extract_id(txt_file.stem)
+        if vac in vacs and held_out(vac):
+            link = subset_dir / txt_file.name
+            link.symlink_to(txt_file.resolve())
+            links.append(link)
+
+    return links
+
+
+def variant_dir(name: str) -> Path:
+    return benchmark_dir / name / "extracted"
+
+
+def run_variant(variant: dict):
+    """Extract the subset with extract_tabular.py, in a separate process, with the variant settings."""
+    settings = {k: v for k, v in variant.items() if k != "name"}
+
+    print(f"Extracting with {variant['name']}: {settings}")
+    extract_tabular.run_in_subprocess(
+        subset_dir, variant_dir(variant["name"]), settings, benchmark_dir / variant["name"] / "config.yaml"
+    )
+
+
+def run_stats(out_dir: Path) -> dict:
+    """Totals of the extraction runs that produced the current outputs, i.e. with the latest configuration."""
+    runs = extract_tabular.latest_runs(out_dir)
+
+    n_reports = sum(run["n_reports"] for run in runs)
+    seconds = sum(run["seconds"] for run in runs)
+    gpu_seconds = sum(run["seconds"] * run["n_gpus"] for run in runs)
+
+    def rate(x, y):
+        return x / y if y else None
+
+    return {
+        "reports_per_s": rate(n_reports, seconds),
+        "prompt_tokens_per_s": rate(sum(run["prompt_tokens"] for run in runs), seconds),
+        "output_tokens_per_s": rate(sum(run["output_tokens"] for run in runs), seconds),
+        "gpu_hours_per_1k_reports": rate(gpu_seconds / 3600 * 1000, n_reports),
+    }
+
+
+def score_variant(name: str, subset: list[Path], clinical: pl.DataFrame) -> tuple[dict, pl.DataFrame]:
+    """Summary row and per-field table of a variant."""
+    out_dir = variant_dir(name)
+    texts = outputs.read_texts(out_dir)
+
+    rows = []
+    tiers = Counter()
+    n_failed = 0
+    n_with_errors = 0
+
+    for txt_file in subset:
+        filename = txt_file.stem + ".json"
+
+        if filename not in texts:
+            tiers["missing"] += 1
+            continue
+
+        row, _, errors, tier, _ = json_to_tabular.process_output(filename, texts[filename])
+        tiers[tier] += 1
+        n_with_errors += bool(errors)
+
+        # unparsable, or parsed to something else than a JSON object (a list, a string)
+        if row is None:
+            n_failed += 1
+        else:
+            rows.append(row)
+
+    n = len(subset)
+    summary = {
+        "variant": name,
+        "n_reports": n,
+        "missing_rate": tiers["missing"] / n,
+        "schema_failure_rate": n_failed / n,
+        "repaired_rate": (tiers["fences"] + tiers["repair"]) / n,
+        "field_error_rate": n_with_errors / n,
+        **run_stats(out_dir),
+    }
+
+    fields = list(Report.model_fields)
+
+    extracted = (
+        pl.DataFrame(rows, infer_schema_length=None).drop("VAC")
+        if rows
+        else pl.DataFrame({"filename": [], **{f: [] for f in fields}}, schema_overrides={"filename": pl.String})
+    )
+
+    # one row per report of the subset, all null for the reports without a usable output
+    reports = pl.DataFrame(
+        {
+            "filename": [txt_file.stem + ".json" for txt_file in subset],
+            "VAC": [extract_id(txt_file.stem) for txt_file in subset],
+        }
+    ).join(extracted.with_columns(extracted=pl.lit(True)), on="filename", how="left")
+
+    # over the reports with a usable output only, the others are counted by missing_rate and schema_failure_rate
+    null_counts = extracted.select(pl.col(fields).is_null().sum())
+
+    truth = clinical.select(pl.all().name.prefix("truth_")).rename({"truth_VAC": "VAC"})
+    joined = reports.join(truth, on="VAC", how="left")
+    has_output = pl.col("extracted").fill_null(False)
+
+    field_rows = []
+    for field in fields:
+        field_row = {"variant": name, "field": field, "null_rate": null_counts[field][0] / len(rows) if rows else None}
+
+        if field in comparisons:
+            value, truths, tolerance = comparisons[field]
+
+            if tolerance is None:
+                match = pl.any_horizontal([t == value for t in truths])
+            else:
+                match = pl.min_horizontal([(t - value).abs() for t in truths]) <= tolerance
+
+            has_truth = pl.any_horizontal([t.is_not_null() for t in truths])
+
+            scores = joined.select(
+                has_truth.sum().alias("n_truth"),
+                (has_truth & has_output).sum().alias("n_covered"),
+                (has_truth & match.fill_null(False)).sum().alias("n_correct"),
+            ).row(0, named=True)
+
+            field_row["n_truth"] = scores["n_truth"]
+            field_row["coverage"] = scores["n_covered"] / scores["n_truth"] if scores["n_truth"] else None
+            field_row["accuracy"] = scores["n_correct"] / scores["n_truth"] if scores["n_truth"] else None
+
+        field_rows.append(field_row)
+
+    return summary, pl.DataFrame(
+        field_rows,
+        schema={"variant": pl.String, "field": pl.String, "null_rate": pl.Float64, "n_truth": pl.Int64, "coverage": pl.Float64, "accuracy": pl.Float64},
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extraction accuracy benchmark")
+    parser.add_argument("--variants", nargs="*", help="names of the variants to run, all of them by default")
+    parser.add_argument("--score-only", action="store_true", help="score existing extractions without running the model")
+    args = parser.parse_args()
+
+    variants = [OmegaConf.to_container(v) for v in config.benchmark.variants]
+    if args.variants:
+        variants = [v for v in variants if v["name"] in args.variants]
+
+    clinical = load_clinical()
+    subset = make_subset(clinical)
+    print(f"{len(subset)} held-out reports")
+
+    if not args.score_only:
+        for variant in variants:
+            run_variant(variant)
+
+    summaries = []
+    field_tables = []
+
+    for variant in variants:
+        summary, field_table = score_variant(variant["name"], subset, clinical)
+        summaries.append(summary)
+        field_tables.append(field_table)
+
+    summary = pl.DataFrame(summaries)
+    fields = pl.concat(field_tables)
+
+    summary.write_parquet(benchmark_dir / "summary.parquet")
+    fields.write_parquet(benchmark_dir / "fields.parquet")
+
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200):
+        print(summary)
+        print(fields.filter(pl.col("accuracy").is_not_null()).pivot("variant", index="field", values="accuracy"))
+        print(fields.pivot("variant", index="field", values="null_rate"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+# Model cascade: extract every report with a small model (cascade.small in config.yaml), and
+# only the reports whose output is unreliable with the large one (the extraction settings).
+#
+# A small-model output is escalated to the large model if
+#   missing             the request failed, there is no output
+#   unparsable          the output could not be parsed as JSON
+#   invalid             some field failed validation against Report
+#   missing_rule_field  a field is null although the rules in rules.py find it in the report with
+#                       high confidence (from the stored _meta.rules with extraction.rules, the
+#                       rules are run again otherwise)
+#   rules_disagree      the model disagrees with ambiguous rule matches (with extraction.rules)
+#   low_agreement       a field agreement is below cascade.min_agreement (with extraction.samples > 1)
+#
+# Each tier runs extract_tabular.py in its own process and directory under cascade.dir, so
+# both are resumable and the GPUs are released between them. If the large model fails on an
+# escalated report too (no output, or not a JSON object), the small-model output is kept,
+# with "large_failed" among its reasons.
+#
+# The chosen output of every report is written, with its manifest entry, to its own extracted
+# directory cascade.dir/extracted (see outputs.py), with the tier, model and escalation reasons
+# under "_meta" (the extraction_meta column of json_to_tabular.py). Its manifest keys are those
+# of the tier that produced each output, so it is never mistaken for the outputs of a plain run
+# of extract_tabular.py in paths.extracted_dir. To tabulate it, point paths.extracted_dir to it.
+# The GPU-hours of both tiers, and of the large model alone, are appended to
+# cascade.dir/cascade.jsonl.
+#
+# Needs GPUs, submit it like extract_tabular.sh:
+#   uv run src/cascade.py
+
+import json
+import time
+from collections import Counter
+from pathlib import Path
+
+from omegaconf import OmegaConf
+
+import extract_tabular
+import json_to_tabular
+import metrics
+import outputs
+import rules
+from config import config
+
+cascade_dir = Path(config.cascade.dir)
+small_dir = cascade_dir / "small" / "extracted"
+large_dir = cascade_dir / "large" / "extracted"
+# links to the reports escalated to the large model
+escalated_dir = cascade_dir / "escalated"
+# the chosen output of every report
+chosen_dir = cascade_dir / "extracted"
+
+small_model = config.cascade.small.model
+large_model = config.extraction.model
+
+
+def escalation_reasons(txt_file: Path, text: str | None) -> list[str]:
+    """Why the small-model output of a report is not good enough, empty if it is."""
+    if text is None:
+        return ["missing"]
+
+    row, _, errors, _, _ = json_to_tabular.process_output(txt_file.stem + ".json", text)
+
+    if row is None:
+        return ["unparsable"]
+
+    reasons = []
+
+    if errors:
+        reasons.append("invalid")
+
+    meta = json.loads(row["extraction_meta"]) if row["extraction_meta"] is not None else {}
+
+    # fields the rules are sure of, the ones rules.combine takes without the model; loose
+    # matches are often right to be null. Already found by the run itself with extraction.rules
+    results = meta.get("rules")
+    if results is None:
+        results = rules.extract_rules(txt_file.read_text(encoding="utf-8"))
+
+    if any(row[field] is None for field in rules.resolved_fields(results)):
+        reasons.append("missing_rule_field")
+
+    if meta.get("disagreements"):
+        reasons.append("rules_disagree")
+
+    agreement = meta.get("agreement")
+    if agreement and min(agreement.values()) < config.cascade.min_agreement:
+        reasons.append("low_agreement")
+
+    return reasons
+
+
+def link_escalated(txt_files: list[Path]):
+    """Make escalated_dir hold exactly these reports, the input of the large model."""
+    escalated_dir.mkdir(parents=True, exist_ok=True)
+
+    for link in escalated_dir.glob("*.txt"):
+        link.unlink()
+
+    for txt_file in txt_files:
+        (escalated_dir / txt_file.name).symlink_to(txt_file.resolve())
+
+
+def latest_rows(out_dir: Path) -> dict[str, dict]:
+    """{filename: row} of the outputs dataset of a tier."""
+    return {row["filename"]: row for row in outputs.scan(out_dir).collect().iter_rows(named=True)}
+
+
+def parsed(row: dict | None) -> dict | None:
+    """The output of a row as a JSON object, None if there is no output or it is not one."""
+    if row is None:
+        return None
+
+    data, _ = json_to_tabular.parse_output(row["filename"], row["text"], log=[])
+
+    return data if isinstance(data, dict) else None
+
+
+def with_tier(row: dict, tier: str, model: str, reasons: list[str]) -> dict:
+    """The output row of a report with where it comes from under "_meta", to be written again."""
+    row = {k: v for k, v in row.items() if k != "written"}
+    data = parsed(row)
+
+    if data is not None:
+        data.setdefault("_meta", {}).update(tier=tier, model=model, escalation=reasons)
+        row["text"] = json.dumps(data, indent=2)
+
+    return row
+
+
+def gpu_hours(out_dir: Path) -> tuple[float, int]:
+    """GPU-hours and number of reports of the runs that produced the current outputs of a tier."""
+    runs = extract_tabular.latest_runs(out_dir)
+    return sum(run["seconds"] * run["n_gpus"] for run in runs) / 3600, sum(run["n_reports"] for run in runs)
+
+
+def main():
+    txt_files = sorted(extract_tabular.txt_path.glob("*.txt"))
+    print(f"{len(txt_files)} reports")
+
+    print(f"Tier 1: extracting with {small_model}")
+    extract_tabular.run_in_subprocess(
+        extract_tabular.txt_path, small_dir, OmegaConf.to_container(config.cascade.small), cascade_dir / "small" / "config.yaml"
+    )
+
+    small = latest_rows(small_dir)
+    reasons = {
+        txt_file: escalation_reasons(txt_file, small.get(txt_file.stem + ".json", {}).get("text"))
+        for txt_file in txt_files
+    }
+    escalated = [txt_file for txt_file in txt_files if reasons[txt_file]]
+
+    counts = Counter(reason for report_reasons in reasons.values() for reason in report_reasons)
+    print(f"Escalating {len(escalated)} of {len(txt_files)} reports: {dict(counts)}")
+
+    link_escalated(escalated)
+
+    if escalated:
+        print(f"Tier 2: extracting with {large_model}")
+        extract_tabular.run_in_subprocess(escalated_dir, large_dir, {}, cascade_dir / "large" / "config.yaml")
+
+    large = latest_rows(large_dir) if escalated else {}
+
+    rows = []
+    tiers = Counter()
+    n_large_failed = 0
+    for txt_file in txt_files:
+        filename = txt_file.stem + ".json"
+        report_reasons = reasons[txt_file]
+
+        if report_reasons:
+            row, tier, model = large.get(filename), "large", large_model
+
+            if parsed(row) is None:
+                # keep what the small model gave, if anything
+                row, tier, model = small.get(filename), "small", small_model
+                report_reasons = report_reasons + ["large_failed"]
+                n_large_failed += 1
+        else:
+            row, tier, model = small.get(filename), "small", small_model
+
+        if row is not None:
+            rows.append(with_tier(row, tier, model, report_reasons))
+            tiers[tier] += 1
+
+    chosen_dir.mkdir(parents=True, exist_ok=True)
+    extract_tabular.write_batch(rows, chosen_dir, chosen_dir / "manifest.jsonl", f"{metrics.new_run_id()}-cascade")
+
+    small_hours, _ = gpu_hours(small_dir)
+    large_hours, n_large = gpu_hours(large_dir)
+    # what extracting every report with the large model would have cost, at the same rate
+    large_only_hours = large_hours / n_large * len(txt_files) if n_large else None
+
+    summary = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "small_model": small_model,
+        "large_model": large_model,
+        "n_reports": len(txt_files),
+        "n_escalated": len(escalated),
+        "reasons": dict(counts),
+        "n_large_failed": n_large_failed,
+        "rows_by_tier": dict(tiers),
+        "small_gpu_hours": small_hours,
+        "large_gpu_hours": large_hours,
+        "large_only_gpu_hours": large_only_hours,
+    }
+
+    with open(cascade_dir / "cascade.jsonl", "a", encoding="utf-8") as f:
+        f.write(json.dumps(summary) + "\n")
+
+    print(f"Rows by tier: {dict(tiers)}, {n_large_failed} kept from the small model after the large one failed")
+    print(f"Wrote {len(rows)} outputs to {chosen_dir}")
+    print(f"GPU-hours: {small_hours:.3f} small + {large_hours:.3f} large", end="")
+    if large_only_hours is not None:
+        print(f", vs. about {large_only_hours:.3f} with the large model alone")
+    else:
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+# The clinical spreadsheet (ground truth for the extraction), cleaned once and cached.
+#
+# The xlsx file has the data dictionary in the column names, e.g.
+#   "Race 1.Caucasian 2. Africanamerican 3. Asian 4.other"
+# and duplicated names disambiguated by Polars with a suffix ("MOCA Total_1"). The columns
+# are renamed with rename_map, as done in notebooks/00 - Demographics.ipynb, and every
+# column with a data dictionary in its name is decoded into an Enum of its labels, keeping
+# the numeric code in <name>_code. Codes that are not in the dictionary become null.
+#
+# Reading the xlsx takes seconds, so the clean table is cached as Parquet together with
+# the mtime and size of the xlsx file it was made from, and rebuilt only when those change:
+#
+#   from clinical_spreadsheet import load_clinical
+#   clinical = load_clinical()
+
+import re
+from pathlib import Path
+
+import polars as pl
+
+from config import config
+
+spreadsheet_path = Path(config.paths.spreadsheet)
+cache_path = Path(config.paths.clinical)
+
+# patients with almost no data
+excluded_vacs = [1448]
+
+# renaming scheme for the columns in the excel sheet to a more usable format, removing the data dictionary from column name and disambiguating duplicated columns
+rename_map = {
+    'VAC': 'VAC',
+    'Data collection by': 'data_collector',
+    '# Appts: 1,2,3,4,5,6, NA (duplicate)': 'num_appts',
+    'Age At Consult': 'age_at_consult',
+    'Year of Birth': 'year_of_birth',
+    'sex': 'sex',
+    'Educ Yrs': 'education_years',
+    'Race 1.Caucasian 2. Africanamerican 3. Asian 4.other': 'race',
+    'ethnicity 0.non hispanic 1.hispanic': 'ethnicity',
+    'occupation 1. working 2. retired 3. unemployed': 'occupation',
+    'Marital status 1. Single never married 2. married 3. divorced/widowed': 'marital_status',
+    'living situation 1. Alone 2. Family 3. CRC 4. ALF 5. NH 6. inpatient': 'living_situation',
+    'aPET 0. No 1. Yes': 'apet',
+    'Date Performed': 'date_performed',
+    '# of visits until PET ordered': 'visits_until_pet',
+    'PET result 1.Normal 2.Abnormal': 'pet_result',
+    '1st Appt Date': 'appt_date_1',
+    'MOCA': 'moca_1',
+    't-MOCA': 'tmoca_1',
+    'Function 1.independent 2. dep any iADLs 3. dependent all iADLs 4.  dep any bADLs 5. dependent all bADLs ': 'function_1',
+    'Behavioral disturbance 0. No 1. Yes (anger, irritability, disinhibition)': 'behavioral_disturbance_1',
+    'Cognitive syndrome 1st 1.Unimpaired 2.SCD 3. MCI 4. Dementia': 'cognitive_syndrome_1',
+    'NBSE Date': 'nbse_date',
+    'Second visit date': 'fu_date_2',
+    'MoCA': 'moca_2',
+    't-MOCA_1': 'tmoca_2',
+    'Function 1.independent 2. dep any iADLs 3. dependent all iADLs 4.  dep any bADLs 5. dependent all bADLs _1': 'function_2',
+    'Behavioral disturbance 0.No 1.Yes': 'behavioral_disturbance_2',
+    'Cognitive syndrome 2nd 1.Unimpaired 2.SCD 3. MCI 4. Dementia': 'cognitive_syndrome_2',
+    'Medication Change 0.No 1.Yes': 'med_change_1',
+    'Living situation change 0.No 1.Yes': 'living_situation_change_1',
+    "DC'd 0.no 1.yes": 'discharged_1',
+    '3rd Visit': 'fu_date_3',
+    'MOCA Total': 'moca_3',
+    't-MOCA_2': 'tmoca_3',
+    'Function 1.independent 2. dep any iADLs 3. dependent all iADLs 4.  dep any bADLs 5. dependent all bADLs _2': 'function_3',
+    'Behavioral disturbance  0.No 1.Yes': 'behavioral_disturbance_3',
+    'Cognitive syndrome 1st 1.Unimpaired 2.SCD 3. MCI 4. Dementia_1': 'cognitive_syndrome_3',
+    'Med Change 0.No 1.Yes': 'med_change_2',
+    'Living situation change 0.No 1.Yes_1': 'living_situation_change_2',
+    "DC'd 0.no 1.yes_1": 'discharged_2',
+    'Fourth fu date': 'fu_date_4',
+    'MOCA Total_1': 'moca_4',
+    't-MoCA': 'tmoca_4',
+    'Function 1.independent 2. dep any iADLs 3. dependent all iADLs 4.  dep any bADLs 5. dependent all bADLs _3': 'function_4',
+    'Behavioral disturbance  0.No 1.Yes_1': 'behavioral_disturbance_4',
+    'Cognitive syndrome 1st 1.Unimpaired 2.SCD 3. MCI 4. Dementia_2': 'cognitive_syndrome_4',
+    'Med Change 0.No 1.Yes_1': 'med_change_3',
+    'Living situation change 0.No 1.Yes_2': 'living_situation_change_3',
+    'Discharged0.no 1.yes': 'discharged_3',
+    'Fifth fu date': 'fu_date_5',
+    'MOCA Total_2': 'moca_5',
+    't-MoCA_1': 'tmoca_5',
+    'Function 1.independent 2. dep any iADLs 3. dependent all iADLs 4.  dep any bADLs 5. dependent all bADLs _4': 'function_5',
+    'Behavioral disturbance  0.No 1.Yes_2': 'behavioral_disturbance_5',
+    'Cognitive syndrome 1st 1.Unimpaired 2.SCD 3. MCI 4. Dementia_3': 'cognitive_syndrome_5',
+    'Medication Change 0.No 1.Yes_1': 'med_change_4',
+    'Living situation change 0.No 1.Yes_3': 'living_situation_change_4',
+    'Discharged0.no 1.yes_1': 'discharged_4',
+    'Sixth fu date': 'fu_date_6',
+    'MOCA_1': 'moca_6',
+    't-MOCA_3': 'tmoca_6',
+    'Function 1.independent 2. dep any iADLs 3. dependent all iADLs 4.  dep any bADLs 5. dependent all bADLs _5': 'function_6',
+    'Behavioral disturbance  0.No 1.Yes_3': 'behavioral_disturbance_6',
+    'Cognitive syndrome 1st 1.Unimpaired 2.SCD 3. MCI 4. Dementia_4': 'cognitive_syndrome_6',
+    'Med Change 0.No 1.Yes_2': 'med_change_5',
+    'Living Situation Changed 0. No 1. Yes': 'living_situation_change_5',
+    'Discharged0.no 1.yes_2': 'discharged_5',
+}
+
+
+def parse_enum_string(s: str) -> dict[int, str]:
+    """Data dictionary in a column name, e.g. "aPET 0. No 1. Yes" -> {0: "No", 1: "Yes"}."""
+    # the suffix Polars adds to duplicated column names is not part of the last label
+    s = re.sub(r"_\d+$", "", s)
+
+    parts = re.split(r'(?=\d+\.)', s)  # split before occurrences like "1."
+    result = {}
+    for part in parts:
+        m = re.match(r'\s*(\d+)\.\s*(.*)', part)
+        if m:
+            key = int(m.group(1))
+            value = m.group(2).strip()
+            if value:
+                result[key] = value
+    return result
+
+
+# column -> {code: label}, for every column with a data dictionary in its original name
+value_mapping = {
+    new: parse_enum_string(old) for old, new in rename_map.items() if "." in old
+}
+
+
+def leading_int(col: str) -> pl.Expr:
+    """First integer in a column of any type, e.g. "12-14" -> 12 (ranges are rounded down)."""
+    return pl.col(col).cast(pl.String).str.extract(r"(\d+)").cast(pl.Int64)
+
+
+def decode(col: str, mapping: dict[int, str]) -> list[pl.Expr]:
+    """<col>_code with the valid codes only, and col as an Enum of the labels."""
+    code = leading_int(col)
+    code = pl.when(code.is_in(list(mapping))).then(code)
+
+    labels = pl.Enum(list(dict.fromkeys(mapping.values())))
+
+    return [
+        code.alias(f"{col}_code"),
+        code.replace_strict(mapping, default=None, return_dtype=pl.String).cast(labels).alias(col),
+    ]
+
+
+def clean_spreadsheet(raw: pl.DataFrame) -> pl.DataFrame:
+    """Rename, parse and decode the columns of the spreadsheet as read from the xlsx file."""
+    clinical = raw.rename(rename_map, strict=False)
+
+    decoded = [e for col, mapping in value_mapping.items() if col in clinical.columns for e in decode(col, mapping)]
+
+    return (
+        clinical.with_columns(
+            leading_int("VAC"),
+            leading_int("num_appts"),
+            leading_int("education_years"),
+            leading_int("age_at_consult"),
+            pl.col("sex").cast(pl.String).str.strip_chars(" ").str.to_uppercase().cast(pl.Categorical),
+            pl.col("data_collector").cast(pl.Categorical),
+            *decoded,
+        )
+        .filter(~pl.col("VAC").is_in(excluded_vacs))
+        .sort("VAC")
+    )
+
+
+def spreadsheet_key() -> dict[str, str]:
+    stat = spreadsheet_path.stat()
+    return {"source": spreadsheet_path.name, "mtime_ns": str(stat.st_mtime_ns), "size": str(stat.st_size)}
+
+
+def cache_is_fresh() -> bool:
+    """Whether the Parquet cache exists and was written from the current xlsx file. Reads only its metadata."""
+    if not cache_path.exists():
+        return False
+
+    metadata = pl.read_parquet_metadata(cache_path)
+
+    return all(metadata.get(k) == v for k, v in spreadsheet_key().items())
+
+
+def load_clinical(refresh: bool = False) -> pl.DataFrame:
+    """The clean spreadsheet, from the Parquet cache unless the xlsx file changed since it was written."""
+    if not refresh and cache_is_fresh():
+        return pl.read_parquet(cache_path)
+
+    clinical = clean_spreadsheet(pl.read_excel(spreadsheet_path, infer_schema_length=None))
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".tmp.parquet")
+    clinical.write_parquet(tmp_path, metadata=spreadsheet_key())
+    tmp_path.replace(cache_path)
+
+    return clinical
+
+
+def main():
+    clinical = load_clinical(refresh=True)
+    print(f"Wrote {clinical.height} patients, {clinical.width} columns to {cache_path}")
+
+
+if __name__ == "__main__":
+    main()
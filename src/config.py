@@ -0,0 +1,16 @@
+# Project configuration, loaded from config.yaml at the root of the repository.
+#
+#   from config import config
+#   config.paths.tabulated
+
+import os
+from pathlib import Path
+
+from omegaconf import OmegaConf
+
+default_config_path = Path(__file__).resolve().parents[1] / "config.yaml"
+
+config = OmegaConf.load(default_config_path)
+
+if "NBSE_CONFIG" in os.environ:
+    config = OmegaConf.merge(config, OmegaConf.load(os.environ["NBSE_CONFIG"]))
@@ -0,0 +1,103 @@
+# Lazy access to every table of the project, for notebooks and scripts.
+#
+# Each table is a LazyFrame over its file, with the paths from config.yaml. scan_dataset()
+# joins them into the one table most analyses start from, as a single lazy query:
+# Polars reads only the columns that are eventually selected and pushes filters down
+# to the Parquet scans, so e.g.
+#
+#   import dataset
+#   dataset.scan_dataset(with_acb=True).filter(pl.col("VAC") > 1000).select("VAC", "moca_total_score", "acb_total_score").collect()
+#
+# never loads the full report texts or the unused columns of any table.
+
+import polars as pl
+
+import clinical_spreadsheet
+from config import config
+
+
+def scan_full_reports() -> pl.LazyFrame:
+    """VAC, filename, full_text, nchars, mtime_ns, size, sha256: one row per report, sorted by VAC (make_nbse_table.py)."""
+    return pl.scan_parquet(config.paths.full_reports)
+
+
+def scan_tabulated() -> pl.LazyFrame:
+    """Validated LLM extraction, one row per report (json_to_tabular.py)."""
+    return pl.scan_parquet(config.paths.tabulated)
+
+
+def scan_medications() -> pl.LazyFrame:
+    """VAC, medication, standard_ingredient: one row per ingredient (standardize_meds.py)."""
+    return pl.scan_parquet(config.paths.medications)
+
+
+def scan_acb_scale() -> pl.LazyFrame:
+    """drug, standard_name, acb_score: the anticholinergic burden scale, standardized with RxNorm."""
+    return pl.scan_parquet(config.paths.acb_scale)
+
+
+def scan_spreadsheet(refresh: bool = False) -> pl.LazyFrame:
+    """
+    The clean clinical spreadsheet, one row per patient (clinical_spreadsheet.py). The cache is
+    only written again with refresh=True, otherwise it is just checked against the xlsx file.
+    """
+    if refresh:
+        clinical_spreadsheet.load_clinical(refresh=True)
+    elif not clinical_spreadsheet.cache_is_fresh():
+        print(
+            f"{config.paths.clinical} is missing or older than the spreadsheet, "
+            "run clinical_spreadsheet.py or pass refresh=True"
+        )
+
+    return pl.scan_parquet(config.paths.clinical)
+
+
+def scan_acb_scores() -> pl.LazyFrame:
+    """Anticholinergic burden per patient: acb_total_score, acb_meds_num, ingredient_count."""
+    return (
+        scan_medications()
+        .unique(subset=["VAC", "standard_ingredient"])
+        .join(scan_acb_scale(), left_on="standard_ingredient", right_on="standard_name", how="left")
+        .group_by("VAC")
+        .agg(
+            pl.col("acb_score").sum().alias("acb_total_score"),
+            (pl.col("acb_score") > 0).cast(pl.Int64).sum().alias("acb_meds_num"),
+            pl.col("standard_ingredient").count().alias("ingredient_count"),
+        )
+    )
+
+
+def scan_dataset(
+    columns: list[str] | None = None,
+    with_full_text: bool = False,
+    with_acb: bool = False,
+    with_spreadsheet: bool = False,
+) -> pl.LazyFrame:
+    """
+    One row per extracted report, with nchars (and full_text) of the report and optionally
+    the per-patient ACB scores and the clinical spreadsheet columns (suffixed "_clinical"
+    where the names clash). If columns is given, only those are selected.
+    """
+    report_columns = ["VAC", "stem", "nchars"] + (["full_text"] if with_full_text else [])
+
+    reports = scan_full_reports().with_columns(
+        pl.col("filename").str.replace(r"\.txt$", "").alias("stem")
+    ).select(report_columns)
+
+    lf = (
+        scan_tabulated()
+        .with_columns(pl.col("filename").str.replace(r"\.json$", "").alias("stem"))
+        .join(reports, on=["VAC", "stem"], how="left")
+        .drop("stem")
+    )
+
+    if with_acb:
+        lf = lf.join(scan_acb_scores(), on="VAC", how="left")
+
+    if with_spreadsheet:
+        lf = lf.join(scan_spreadsheet(), on="VAC", how="left", suffix="_clinical")
+
+    if columns is not None:
+        lf = lf.select(columns)
+
+    return lf
@@ -0,0 +1,220 @@
+# Embedding-based alternative to the lexical TF-IDF matching in syndrome_matcher.py.
+#
+# Reference synonyms and extracted strings are encoded with a small sentence-transformers
+# model on CPU and matched by cosine similarity, top-k with a single matrix product per
+# batch. Every vector ever computed is kept on disk (normalized, float32 .npy, opened
+# memory-mapped), so re-runs only embed strings that were not seen before.
+#
+# Like syndrome_matcher.py, clinical_syndrome is matched to data/specific_syndromes_reference.json
+# and diagnosis to data/clinical_diagnoses.json, and the result written to
+# paths.syndromes_embedding.
+
+import json
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+import syndrome_matcher
+from config import config
+
+base_path = Path(config.base_path)
+
+model_name = "sentence-transformers/all-MiniLM-L6-v2"
+vector_cache_dir = base_path / "results/embedding_cache"
+
+# below this cosine similarity the string does not match any reference
+min_similarity = 0.5
+
+
+class VectorCache:
+    """
+    Persistent text -> normalized embedding store: vectors.npy holds one row per text,
+    texts.json the texts in the same order and the model that encoded them.
+    """
+
+    def __init__(self, cache_dir: Path, model_name: str):
+        self.cache_dir = Path(cache_dir)
+        self.model_name = model_name
+        self.model = None
+
+        self.vectors_path = self.cache_dir / "vectors.npy"
+        self.texts_path = self.cache_dir / "texts.json"
+
+        self.texts = []
+        self.vectors = None
+
+        if self.texts_path.exists():
+            with open(self.texts_path) as f:
+                saved = json.load(f)
+
+            # vectors from another model are useless
+            if saved["model"] == model_name:
+                self.texts = saved["texts"]
+                self.vectors = np.load(self.vectors_path, mmap_mode="r")
+
+        self.index = {text: i for i, text in enumerate(self.texts)}
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        if self.model is None:
+            from sentence_transformers import SentenceTransformer
+
+            self.model = SentenceTransformer(self.model_name, device="cpu")
+
+        return self.model.encode(
+            texts, batch_size=256, normalize_embeddings=True, convert_to_numpy=True
+        ).astype(np.float32)
+
+    def get(self, texts: list[str]) -> np.ndarray:
+        """Normalized embeddings of texts, encoding and saving only the ones not cached yet."""
+        new = list(dict.fromkeys(text for text in texts if text not in self.index))
+
+        if new:
+            new_vectors = self.encode(new)
+
+            if self.vectors is None:
+                vectors = new_vectors
+            else:
+                vectors = np.concatenate([self.vectors, new_vectors])
+
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+            # write aside and rename, so that an interrupted run leaves the old cache intact;
+            # texts.json goes last, extra rows in vectors.npy are never looked up
+            tmp_vectors = self.vectors_path.with_suffix(".tmp.npy")
+            np.save(tmp_vectors, vectors)
+            tmp_vectors.replace(self.vectors_path)
+
+            self.texts = self.texts + new
+            tmp_texts = self.texts_path.with_suffix(".json.tmp")
+            with open(tmp_texts, "w") as f:
+                json.dump({"model": self.model_name, "texts": self.texts}, f)
+            tmp_texts.replace(self.texts_path)
+
+            self.index = {text: i for i, text in enumerate(self.texts)}
+            self.vectors = np.load(self.vectors_path, mmap_mode="r")
+
+        return np.asarray(self.vectors[[self.index[text] for text in texts]])
+
+
+class EmbeddingMatcher:
+    """Match strings to the closest synonym of a {synonym: code} reference dictionary by cosine similarity."""
+
+    def __init__(self, references: dict[str, str], cache: VectorCache):
+        self.ref_texts = list(references.keys())
+        self.codes = [references[r] for r in self.ref_texts]
+        self.cache = cache
+        self.ref_vecs = cache.get(self.ref_texts)
+
+    def top_k(self, sentences: list[str], k: int = 3, batch_size: int = 4096):
+        """Indices and similarities of the k closest references of each sentence, best first."""
+        k = min(k, len(self.ref_texts))
+        vecs = self.cache.get(sentences)
+
+        indices = np.zeros((len(sentences), k), dtype=int)
+        sims = np.zeros((len(sentences), k), dtype=np.float32)
+
+        for start in range(0, len(sentences), batch_size):
+            scores = vecs[start:start + batch_size] @ self.ref_vecs.T
+
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+
+            indices[start:start + batch_size] = np.take_along_axis(top, order, axis=1)
+            sims[start:start + batch_size] = np.take_along_axis(top_scores, order, axis=1)
+
+        return indices, sims
+
+    def match(self, sentences: list[str], k: int = 3) -> pl.DataFrame:
+        """One row per sentence with its best reference, and the top k references with their similarities."""
+        unique = list(dict.fromkeys(sentences))
+
+        indices, sims = self.top_k(unique, k)
+
+        matches = pl.DataFrame(
+            {
+                "sentence": unique,
+                "similarity": sims[:, 0] if len(unique) else [],
+                "best_match": [self.ref_texts[row[0]] for row in indices],
+                "code": [self.codes[row[0]] for row in indices],
+                "top_codes": [[self.codes[i] for i in row] for row in indices],
+                "top_similarities": sims.tolist(),
+            },
+            schema_overrides={
+                "sentence": pl.String,
+                "similarity": pl.Float32,
+                "best_match": pl.String,
+                "code": pl.String,
+                "top_codes": pl.List(pl.String),
+                "top_similarities": pl.List(pl.Float32),
+            },
+        )
+
+        return pl.DataFrame({"sentence": sentences}, schema={"sentence": pl.String}).join(
+            matches, on="sentence", how="left", maintain_order="left"
+        )
+
+
+@lru_cache(maxsize=1)
+def vector_cache() -> VectorCache:
+    return VectorCache(vector_cache_dir, model_name)
+
+
+@lru_cache
+def load_matcher(reference_path: Path) -> EmbeddingMatcher:
+    """Matcher for a reference file, all of them sharing one vector cache."""
+    with open(reference_path) as f:
+        return EmbeddingMatcher(json.load(f), vector_cache())
+
+
+def normalize_syndromes(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Add syndrome_code and diagnosis_code columns to a frame with VAC, clinical_syndrome and
+    diagnosis columns, like syndrome_matcher.normalize_syndromes, with the similarity and the
+    top codes of each. Null inputs and weak matches (similarity < min_similarity) get a null code.
+    """
+    syndromes = df["clinical_syndrome"].str.to_lowercase().drop_nulls().unique().to_list()
+    diagnoses = df["diagnosis"].drop_nulls().unique().to_list()
+
+    # strings that name a diagnosis rather than a specific syndrome, without lemmatizing
+    not_syndromes = [s for s in syndromes if syndrome_matcher.strip_punctuation(s) in syndrome_matcher.remove_from_syndrome]
+
+    syndrome_matches = load_matcher(syndrome_matcher.syndrome_reference_path).match(syndromes).select(
+        pl.col("sentence").alias("syndrome_key"),
+        pl.when(pl.col("similarity") < min_similarity)
+        .then(None)
+        .when(pl.col("sentence").is_in(not_syndromes))
+        .then(None)
+        .otherwise(pl.col("code"))
+        .alias("syndrome_code"),
+        pl.col("similarity").alias("syndrome_similarity"),
+        pl.col("top_codes").alias("syndrome_top_codes"),
+    )
+
+    diagnosis_matches = load_matcher(syndrome_matcher.diagnosis_reference_path).match(diagnoses).select(
+        pl.col("sentence").alias("diagnosis"),
+        pl.when(pl.col("similarity") < min_similarity).then(None).otherwise(pl.col("code")).alias("diagnosis_code"),
+        pl.col("similarity").alias("diagnosis_similarity"),
+        pl.col("top_codes").alias("diagnosis_top_codes"),
+    )
+
+    return (
+        df.with_columns(pl.col("clinical_syndrome").str.to_lowercase().alias("syndrome_key"))
+        .join(syndrome_matches, on="syndrome_key", how="left", maintain_order="left")
+        .join(diagnosis_matches, on="diagnosis", how="left", maintain_order="left")
+        .drop("syndrome_key")
+    )
+
+
+def main():
+    tabular = pl.read_parquet(config.paths.tabulated).select(
+        "VAC", "diagnosis", "clinical_syndrome"
+    )
+
+    normalize_syndromes(tabular).write_parquet(config.paths.syndromes_embedding)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# Server mode of extract_tabular.py (mode = "server").
+#
+# Instead of loading the model in-process, send each report to a running OpenAI-compatible
+# server, e.g.
+#   vllm serve Qwen/Qwen3-32B --tensor-parallel-size 2 --max-model-len 32768
+# keeping at most max_in_flight requests open at a time. Each response is validated against
+# Report as soon as it arrives and its cleaned row appended to paths.stream_output, and only
+# then is its raw output queued to be saved like in offline mode (outputs dataset + manifest),
+# in batches of flush_size and at the end of every poll. A report that fails before it is
+# streamed is never in the manifest, so it is retried; a killed run re-extracts at most one
+# batch, whose reports are already in the stream and are not appended again (the stream rows
+# carry the manifest key). With extraction.watch_interval > 0 the data directory is polled
+# for new reports forever.
+#
+# stub_openai_server.py answers with canned JSON, to try this out without a GPU.
+
+import asyncio
+import itertools
+import json
+
+import backends
+import extract_tabular as et
+import metrics
+from nbse_report_schema_minimal import Report
+from json_to_tabular import log_file, parse_json, validate_and_clean_data
+from report_files import extract_id
+
+
+# output rows not written to the outputs dataset yet
+unsaved = []
+flush_size = 256
+batch_names = (f"{metrics.new_run_id()}-server-{i:05d}" for i in itertools.count())
+
+# (filename, key) of the rows in the stream file, so that a report is never streamed twice
+streamed = set()
+
+
+def load_streamed():
+    """Fill streamed from the stream file. A truncated last line (run killed mid-write) is ignored."""
+    if not et.stream_output_path.exists():
+        return
+
+    with open(et.stream_output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            streamed.add((row["filename"], row.get("key")))
+
+
+def flush():
+    """Write the unsaved outputs as one batch and record them in the manifest."""
+    if unsaved:
+        et.write_batch(unsaved, et.output_path, et.manifest_path, next(batch_names))
+        unsaved.clear()
+
+
+def stream_row(filename: str, key: str, text: str):
+    """
+    Append the validated row of an output to the streaming table, unless it is there already.
+    Invalid fields are set to None, as in json_to_tabular.py.
+    """
+    if (filename, key) in streamed:
+        return
+
+    log = [filename]
+    data, _ = parse_json(text)
+
+    if not isinstance(data, dict):
+        print(f"{filename}: output is not a JSON object")
+        return
+
+    report = validate_and_clean_data(data, Report, log=log)
+
+    row = report.model_dump(mode="json")
+    row["filename"] = filename
+    row["VAC"] = extract_id(filename)
+    row["key"] = key
+    del row["vac"]  # use the one parsed by the filename
+
+    with open(et.stream_output_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(row) + "\n")
+
+    streamed.add((filename, key))
+
+    if len(log) > 1:
+        with log_file.open("a", encoding="utf-8") as f:
+            f.write("\n".join(log) + "\n")
+
+
+def save_result(txt_file, key: str, prompt: backends.Prompt, completion: backends.Completion, config_digest: str):
+    """
+    Stream the validated row of the output, then queue the raw output to be saved. If
+    streaming fails the report stays out of the manifest and is extracted again.
+    """
+    stream_row(txt_file.stem + ".json", key, completion.text)
+
+    unsaved.append(et.output_row(txt_file, key, completion.text, [prompt], [completion], config_digest))
+    if len(unsaved) >= flush_size:
+        flush()
+
+
+async def worker(backend: backends.OpenAIBackend, client, queue: asyncio.Queue, prefix: str, suffix: str, config_digest: str):
+    while True:
+        txt_file, report_text, key = await queue.get()
+
+        try:
+            prompt = backend.prepare(prefix + report_text + suffix)
+            completion = await backend.complete(client, prompt.text)
+            save_result(txt_file, key, prompt, completion, config_digest)
+        except Exception as e:
+            # leave it out of the manifest, it will be retried on the next poll or run
+            print(f"{txt_file.name}: failed, {e}")
+        finally:
+            queue.task_done()
+
+
+async def run(schema: dict, prefix: str, suffix: str, config_digest: str):
+    et.stream_output_path.parent.mkdir(parents=True, exist_ok=True)
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    load_streamed()
+
+    backend = backends.OpenAIBackend(et.model_name, et.sampling_config, schema, et.server_url, et.max_in_flight)
+    client = backend.client()
+
+    queue = asyncio.Queue()
+
+    workers = [
+        asyncio.create_task(worker(backend, client, queue, prefix, suffix, config_digest))
+        for _ in range(et.max_in_flight)
+    ]
+
+    while True:
+        _, todo = et.find_pending(config_digest)
+
+        for item in todo:
+            queue.put_nowait(item)
+
+        await queue.join()
+        flush()
+
+        if todo:
+            print(f"Extracted {len(todo)} reports")
+
+        if et.watch_interval <= 0:
+            break
+
+        await asyncio.sleep(et.watch_interval)
+
+    for w in workers:
+        w.cancel()
+
+    await client.close()
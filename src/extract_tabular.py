@@ -1,58 +1,631 @@
 from pathlib import Path
-from vllm import LLM, SamplingParams
-from pathlib import Path
+import backends
+import metrics
+import outputs
 import prompt_templates
+import rules
+import sections
 from nbse_report_schema_minimal import Report
-from itertools import batched
-
-prompt_template = prompt_templates.TABULAR_TEMPLATE_SCHEMA
-
-txt_path = Path("data/NBSE_txt")
-output_path = Path("results/tabular_extracted_flashinfer/")
-
-# Initialize vLLM
-model_name = "Qwen/Qwen3-32B" # this is the best at complying with schema
-# model_name = "Qwen/Qwen3-14B"
-# model_name = "Qwen/Qwen3-8B"
-# model_name = "Qwen/Qwen3-4B"
-# model_name = 'Qwen/Qwen3-30B-A3B-Instruct-2507' # models from this family fail on vllm 0.1.10 with some mysterious error
-max_tokens = 32768
-temperature = 0.7
-top_p = 0.8
-top_k = 20
-max_model_len = 32768
+from report_files import extract_id, load_manifest
+from config import config
+from omegaconf import OmegaConf
+import polars as pl
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import voting
+from collections import Counter, defaultdict
+from dataclasses import replace
+from functools import lru_cache
+
+# With guided decoding vLLM constrains every generated token to the Report JSON schema,
+# so the output is valid JSON that matches the schema by construction: no prose, no code
+# fences, and no need for json_repair downstream.
+guided_decoding = config.extraction.guided_decoding
+
+if guided_decoding:
+    prompt_template = prompt_templates.TABULAR_TEMPLATE_GUIDED
+else:
+    prompt_template = prompt_templates.TABULAR_TEMPLATE_SCHEMA
+
+# Split each report into its sections and extract each one with only the fields it can
+# populate, then merge the outputs into one Report (see sections.py). Prompts are much
+# shorter, so a shorter max_model_len and bigger batches fit in the same memory.
+chunking = config.extraction.chunking
+
+# Take the fields that regexes find with high confidence from the report itself and only
+# ask the model for the others, see rules.py. Prompts are built per part as with chunking.
+use_rules = config.extraction.rules
+
+# Self-consistency: vote over this many samples of every prompt (1 to take a single sample),
+# drawing the first first_samples in one request and the others only if those disagree.
+# Samples of the same request share the prefill of the prompt. See voting.py.
+n_samples = config.extraction.samples
+first_samples = min(config.extraction.first_samples, n_samples)
+
+# one prompt per part of a report, whose outputs are merged, rather than a single raw output
+per_part = chunking or use_rules or n_samples > 1
+
+txt_path = Path(config.paths.txt_dir)
+output_path = Path(config.paths.extracted_dir)
+
+# Where the completions come from, see backends.py: "vllm", "openai" or "replay"
+backend_name = config.extraction.backend
+server_url = config.extraction.server_url
+max_in_flight = config.extraction.max_in_flight
+# Recorded outputs for the replay backend, and where to record the outputs of this run (or None)
+replay_path = config.extraction.replay_path
+record_path = config.extraction.record_path
+
+# "offline": extract in token-budgeted batches with the backend above.
+# "server": stream reports to a running OpenAI-compatible server (vllm serve) as they
+# appear and validate them on arrival, see extract_async.py
+mode = config.extraction.mode
+# In server mode, look for new reports every this many seconds. 0 to stop when done.
+watch_interval = config.extraction.watch_interval
+# In server mode, every validated report is also appended here as one JSON line
+stream_output_path = Path(config.paths.stream_output)
+
+# When submitted as an SGE array job (qsub -t 1-N -v NUM_SHARDS=N) each task extracts a
+# deterministic shard of the corpus, assigned by a stable hash of the VAC id.
+# Otherwise there is a single shard.
+if os.environ.get("SGE_TASK_ID", "undefined") != "undefined":
+    shard_index = int(os.environ["SGE_TASK_ID"]) - 1
+    num_shards = int(os.environ["NUM_SHARDS"])
+else:
+    shard_index = 0
+    num_shards = 1
+
+# One line per extracted report, appended after each batch is safely on disk.
+# A report is skipped on the next run if its key is in any manifest and its output is in
+# the outputs dataset (see outputs.py).
+# Each shard appends to its own manifest, merge_shards.py combines them.
+if num_shards == 1:
+    manifest_path = output_path / "manifest.jsonl"
+else:
+    manifest_path = output_path / f"manifest.shard{shard_index}of{num_shards}.jsonl"
+
+# One line per offline run with its token counts and wall time, read by benchmark.py
+runs_path = output_path / "runs.jsonl"
+
+# Model and sampling parameters are in config.yaml (extraction)
+model_name = config.extraction.model
+tensor_parallel_size = config.extraction.tensor_parallel_size
+# outputs of the replay backend must never be mistaken for outputs of the model
+model_id = f"replay:{model_name}" if backend_name == "replay" else model_name
+max_tokens = config.extraction.max_tokens
+# Only used with guided decoding, see config.yaml
+guided_max_tokens = config.extraction.guided_max_tokens
+temperature = config.extraction.temperature
+top_p = config.extraction.top_p
+top_k = config.extraction.top_k
+max_model_len = config.extraction.max_model_len
 cache_dir = "/projectnb/vkolagrp/bellitti/hf_cache"
 
-llm = LLM(model=model_name, max_model_len=max_model_len, tensor_parallel_size=2)
+# Batches are sized by total tokens rather than number of reports, so that a batch of
+# long reports does not overflow the KV cache and a batch of short ones is not underfilled.
+# vLLM prints the real value at startup ("GPU KV cache size: ... tokens"), adjust accordingly.
+kv_cache_tokens = 400_000
+# Typical length of a completion, used to budget the KV cache for the generated tokens
+expected_output_tokens = 1024
+max_batch_size = 256
 
-sampling_params = SamplingParams(
+# Every prompt starts with the same instructions and schema, only the report at the end changes.
+# With automatic prefix caching vLLM computes the KV cache of that shared prefix once and reuses
+# it for every following prompt. Caching works on whole blocks of this many tokens.
+enable_prefix_caching = True
+block_size = 16
+
+sampling_config = dict(
     temperature=temperature,
-    max_tokens=max_tokens,
+    max_tokens=guided_max_tokens if guided_decoding else max_tokens,
     top_p=top_p,
     top_k=top_k,
+    guided_decoding=guided_decoding,
 )
 
-for batch in batched(txt_path.glob("*.txt"), 256):
 
-    messages_list = []
+def config_hash(template: str, schema: dict, model: str, sampling: dict) -> str:
+    """
+    Hash everything except the report text that determines the model output.
+    Changing the prompt, schema, model or sampling parameters invalidates the manifest.
+    """
+    config = json.dumps(
+        {"template": template, "schema": schema, "model": model, "sampling": sampling},
+        sort_keys=True,
+    )
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()
+
+
+def run_config_digest(schema: dict) -> str:
+    """config_hash of this run; splitting reports into sections, the rules and voting change the outputs too."""
+    if chunking:
+        schema = {"report": schema, "sections": sections.section_spec()}
 
-    for txt_file in batch:
+    if use_rules:
+        schema = {"report": schema, "rules": rules.rules_spec()}
 
+    if n_samples > 1:
+        schema = {"report": schema, "samples": n_samples, "first_samples": first_samples}
+
+    return config_hash(prompt_template, schema, model_id, sampling_config)
+
+
+def extraction_key(report_text: str, config_digest: str) -> str:
+    """Manifest key of a single report: hash of the report text and of the run configuration."""
+    h = hashlib.sha256(config_digest.encode("utf-8"))
+    h.update(report_text.encode("utf-8"))
+    return h.hexdigest()
+
+
+def write_batch(rows: list[dict], out_dir: Path, manifest_file: Path, name: str):
+    """
+    Write a batch of output rows (see outputs.py) as one file of the outputs dataset, which
+    appears atomically, and only then record them in the manifest. Readers of the dataset
+    never see a partially written batch.
+    """
+    outputs.write(rows, out_dir, name)
+
+    with open(manifest_file, "a", encoding="utf-8") as manifest:
+        for row in rows:
+            manifest.write(json.dumps({"file": row["filename"], "key": row["key"]}) + "\n")
+        manifest.flush()
+        os.fsync(manifest.fileno())
+
+
+def output_row(txt_file: Path, key: str, text: str, prompts: list, completions: list, config_digest: str) -> dict:
+    """Row of the outputs dataset of a report, from every prompt and completion that went into its output."""
+    digests = [backends.prompt_digest(prompt.text) for prompt in prompts]
+
+    return {
+        "filename": txt_file.stem + ".json",
+        "VAC": extract_id(txt_file.stem),
+        "key": key,
+        "config": config_digest,
+        "model": model_id,
+        "prompt_hash": digests[0] if len(digests) == 1 else backends.prompt_digest("".join(digests)),
+        "prompt_tokens": sum(completion.prompt_tokens for completion in completions),
+        "output_tokens": sum(completion.output_tokens for completion in completions),
+        "finish_reason": backends.finish_reason_of([completion.finish_reason for completion in completions]),
+        "text": text,
+    }
+
+
+def shard_of(txt_file: Path, n_shards: int) -> int:
+    """
+    Shard a report belongs to. Uses a hash of the VAC id that is stable across runs and
+    machines (unlike hash()), so all reports of a patient always land in the same shard.
+    """
+    vac = extract_id(txt_file.stem)
+    digest = hashlib.sha256(str(vac).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % n_shards
+
+
+def pending_reports(txt_files, manifest: dict[str, str], stored: set[str], config_digest: str):
+    """
+    Yield (txt file, report text, key) for every report that has not been extracted with this
+    configuration, i.e. whose manifest key differs or that is not in the outputs dataset.
+    """
+    for txt_file in txt_files:
         report_text = txt_file.read_text(encoding="utf-8")
+        key = extraction_key(report_text, config_digest)
+        filename = txt_file.stem + ".json"
+
+        if manifest.get(filename) == key and filename in stored:
+            continue
+
+        yield txt_file, report_text, key
+
+
+def render_prompt_parts(template: str, schema: dict) -> tuple[str, str]:
+    """
+    Render the template once, returning the text before and after the report.
+    Every prompt is then prefix + report + suffix, so the prefix (instructions and
+    schema) is byte-identical across all prompts and can be prefix-cached.
+    """
+    schema_text = json.dumps(schema, indent=2)
+    prefix, suffix = template.split("{report}")
+    return prefix.format(schema=schema_text), suffix
 
-        prompt = prompt_template.format(
-            schema=Report.model_json_schema(), report=report_text
+
+def shared_prefix_length(a: list[int], b: list[int]) -> int:
+    """Number of leading tokens two prompts have in common."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+@lru_cache
+def part_prompt_parts(fields: tuple[str, ...]) -> tuple[str, str, dict]:
+    """Prompt prefix and suffix and schema of a part of a report with only these fields."""
+    schema = sections.part_schema(fields)
+    prefix, suffix = render_prompt_parts(prompt_template, schema)
+    return prefix, suffix, schema
+
+
+def report_prompts(backend, report_text: str, prefix: str, suffix: str, resolved: set[str] = frozenset()):
+    """
+    (part, backends.Prompt) of every prompt of a report. Without per_part that is the whole
+    report with part None, otherwise one prompt per section (or the whole report) with
+    part = (section name, fields), leaving out the fields resolved by the rules, asking for
+    first_samples samples. The rules never resolve every field, so there is always a prompt.
+    """
+    if not per_part:
+        return [(None, backend.prepare(prefix + report_text + suffix))]
+
+    if chunking:
+        plan = sections.plan_report(report_text)
+    else:
+        plan = [(sections.FALLBACK, report_text, list(Report.model_fields))]
+
+    prompts = []
+
+    for name, text, fields in plan:
+        fields = [f for f in fields if f not in resolved]
+        if not fields:
+            continue
+
+        part_prefix, part_suffix, schema = part_prompt_parts(tuple(fields))
+        prompt = backend.prepare(part_prefix + text + part_suffix, schema)
+        prompt.n = first_samples
+        prompts.append(((name, fields), prompt))
+
+    return prompts
+
+
+def tokenize_reports(backend, todo, prefix: str, suffix: str):
+    """
+    Render and tokenize every prompt up front, returning (txt file, key, backends.Prompt, part)
+    sorted from the longest to the shortest prompt, and the rule results of every report
+    (empty without rules). Reports with a prompt that does not fit in the context window
+    are reported and dropped, instead of failing a whole batch.
+    """
+    items = []
+    rule_results = {}
+
+    for txt_file, report_text, key in todo:
+
+        if use_rules:
+            rule_results[txt_file] = rules.extract_rules(report_text)
+
+        resolved = rules.resolved_fields(rule_results.get(txt_file, {}))
+
+        prompts = report_prompts(backend, report_text, prefix, suffix, resolved)
+
+        n_tokens = max(prompt.n_tokens for _, prompt in prompts)
+
+        if n_tokens >= max_model_len:
+            print(f"Skipping {txt_file.name}: prompt is {n_tokens} tokens, longer than max_model_len")
+            continue
+
+        items.extend((txt_file, key, prompt, part) for part, prompt in prompts)
+
+    items.sort(key=lambda item: item[2].n_tokens, reverse=True)
+
+    return items, rule_results
+
+
+def token_budget_batches(items, budget: int, output_tokens: int, max_size: int):
+    """
+    Group length-sorted prompts into batches whose prompt + expected completion tokens
+    (of every sample) fit in the budget. Since the input is sorted, each batch holds reports
+    of similar length.
+    """
+    batch = []
+    batch_tokens = 0
+
+    for item in items:
+        cost = item[2].n_tokens + output_tokens * item[2].n
+
+        if batch and (batch_tokens + cost > budget or len(batch) >= max_size):
+            yield batch
+            batch = []
+            batch_tokens = 0
+
+        batch.append(item)
+        batch_tokens += cost
+
+    if batch:
+        yield batch
+
+
+def make_backend(schema: dict):
+    """The backend selected in config.yaml. Only the vllm backend loads the model (and imports vLLM)."""
+    if backend_name == "vllm":
+        return backends.VLLMBackend(
+            model_name,
+            sampling_config,
+            schema,
+            max_model_len=max_model_len,
+            tensor_parallel_size=tensor_parallel_size,
+            enable_prefix_caching=enable_prefix_caching,
+            block_size=block_size,
         )
 
-        messages = [{"role": "user", "content": prompt}]
+    if backend_name == "openai":
+        return backends.OpenAIBackend(model_name, sampling_config, schema, server_url, max_in_flight)
+
+    if backend_name == "replay":
+        return backends.ReplayBackend(replay_path)
+
+    raise ValueError(f"Unknown backend {backend_name!r}, expected vllm, openai or replay")
+
+
+def find_pending(config_digest: str):
+    """List the reports of this shard, and those among them that still need to be extracted."""
+    manifest = {}
+    for path in sorted(output_path.glob("manifest*.jsonl")):
+        manifest |= load_manifest(path)
+
+    txt_files = [
+        txt_file
+        for txt_file in sorted(txt_path.glob("*.txt"))
+        if shard_of(txt_file, num_shards) == shard_index
+    ]
 
-        messages_list.append(messages)
+    stored = set(outputs.scan(output_path).select("filename").collect()["filename"])
 
-    outputs = llm.chat(
-        messages_list, sampling_params, chat_template_kwargs={"enable_thinking": False}
+    todo = list(pending_reports(txt_files, manifest, stored, config_digest))
+
+    return txt_files, todo
+
+
+def latest_runs(out_dir: Path) -> list[dict]:
+    """The runs.jsonl entries of out_dir with the latest configuration, i.e. of the runs that produced the current outputs."""
+    runs_file = out_dir / "runs.jsonl"
+    runs = []
+
+    if runs_file.exists():
+        with open(runs_file, encoding="utf-8") as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+
+    return [run for run in runs if run["config"] == runs[-1]["config"]]
+
+
+def run_in_subprocess(txt_dir: Path, out_dir: Path, settings: dict, config_path: Path):
+    """
+    Extract txt_dir into out_dir with this script in a separate process, with the extraction
+    settings overridden (saved to config_path). vLLM only releases the GPUs when its process
+    ends, so this is how to run several models one after the other.
+    """
+    run_config = OmegaConf.merge(
+        config,
+        {"paths": {"txt_dir": str(txt_dir), "extracted_dir": str(out_dir)}, "extraction": settings},
+    )
+
+    config_path.parent.mkdir(parents=True, exist_ok=True)
+    OmegaConf.save(run_config, config_path, resolve=True)
+
+    env = dict(os.environ, NBSE_CONFIG=str(config_path))
+    # a single shard, even when the caller runs as an array task
+    env.pop("SGE_TASK_ID", None)
+
+    subprocess.run([sys.executable, str(Path(__file__))], env=env, check=True)
+
+
+def main():
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    timer = metrics.StageTimer()
+
+    # names the output batches and the metrics of this run
+    run_suffix = "" if num_shards == 1 else f"_shard{shard_index}of{num_shards}"
+    run_id = metrics.new_run_id(run_suffix)
+
+    schema = Report.model_json_schema()
+    prefix, suffix = render_prompt_parts(prompt_template, schema)
+    config_digest = run_config_digest(schema)
+
+    with timer.stage("find_pending"):
+        txt_files, todo = find_pending(config_digest)
+
+    print(
+        f"Shard {shard_index + 1}/{num_shards}: {len(txt_files)} reports, "
+        f"{len(todo)} to extract, {len(txt_files) - len(todo)} already extracted"
+    )
+
+    if mode == "server":
+        if per_part:
+            raise ValueError("chunking, rules and samples > 1 are only implemented in offline mode")
+
+        import asyncio
+        import extract_async
+
+        asyncio.run(extract_async.run(schema, prefix, suffix, config_digest))
+        return
+
+    if not todo:
+        return
+
+    with timer.stage("load_backend"):
+        backend = make_backend(schema)
+
+    with timer.stage("tokenize"):
+        items, rule_results = tokenize_reports(backend, todo, prefix, suffix)
+
+    if use_rules:
+        n_resolved = sum(len(rules.resolved_fields(found)) for found in rule_results.values())
+        print(f"Rules resolved {n_resolved} fields in {len(rule_results)} reports without the model")
+
+    if not items:
+        return
+
+    n_total = sum(prompt.n_tokens for _, _, prompt, _ in items)
+
+    if backend_name == "vllm":
+        # The prefix is prefilled once, every other prompt reuses its cached full blocks.
+        # With chunking each section has its own prefix, so this is a lower bound.
+        n_shared = min(shared_prefix_length(items[0][2].token_ids, prompt.token_ids) for _, _, prompt, _ in items)
+        n_cached = n_shared // block_size * block_size
+        n_saved = n_cached * (len(items) - 1) if enable_prefix_caching else 0
+        print(
+            f"Shared prompt prefix: {n_shared} tokens. "
+            f"Prefill tokens saved by prefix caching: {n_saved} of {n_total} ({n_saved / n_total:.1%})"
+        )
+
+    n_reports = 0
+    n_prompt_tokens = 0
+    n_output_tokens = 0
+    start = time.perf_counter()
+
+    # one row per prompt, see metrics.py
+    report_metrics = []
+
+    # with per_part, outputs of the parts of each report until they are all there
+    n_parts = Counter(txt_file for txt_file, _, _, _ in items)
+    part_outputs = defaultdict(list)
+    n_to_write = len(n_parts)
+
+    # every (prompt, completion) of each report until it is written, for its output row
+    used = defaultdict(list)
+
+    # with samples > 1: prompts whose first samples disagree, their samples so far, and
+    # per report the agreement of every field and the samples drawn for every part
+    resample = []
+    drawn = {}
+    agreement = defaultdict(dict)
+    n_drawn = defaultdict(dict)
+
+    def all_batches():
+        yield from token_budget_batches(items, kv_cache_tokens, expected_output_tokens, max_batch_size)
+        # filled while the first round runs
+        resample.sort(key=lambda item: item[2].n_tokens, reverse=True)
+        yield from token_budget_batches(resample, kv_cache_tokens, expected_output_tokens, max_batch_size)
+
+    for batch_index, batch in enumerate(all_batches()):
+
+        prompts = [prompt for _, _, prompt, _ in batch]
+
+        batch_start = time.perf_counter()
+
+        with timer.stage("generate"):
+            completions = backend.generate(prompts)
+
+        batch_seconds = time.perf_counter() - batch_start
+
+        # failed requests are left out of the manifest and retried on the next run,
+        # with chunking a report is written once the outputs of all its parts are in
+        results = []
+
+        for (txt_file, key, prompt, part), completion in zip(batch, completions):
+            if completion.text is None:
+                continue
+
+            if part is None:
+                results.append(output_row(txt_file, key, completion.text, [prompt], [completion], config_digest))
+                continue
+
+            used[txt_file].append((prompt, completion))
+
+            text = completion.text
+
+            if n_samples > 1:
+                texts = drawn.pop((txt_file, part[0]), []) + (completion.texts or [completion.text])
+                values, part_agreement = voting.vote(texts, part[1])
+
+                if len(texts) < n_samples and not voting.unanimous(part_agreement):
+                    drawn[(txt_file, part[0])] = texts
+                    resample.append((txt_file, key, replace(prompt, n=n_samples - len(texts)), part))
+                    continue
+
+                text = json.dumps(values)
+                agreement[txt_file] |= part_agreement
+                n_drawn[txt_file][part[0]] = len(texts)
+
+            part_outputs[txt_file].append((part[1], text))
+
+            if len(part_outputs[txt_file]) == n_parts[txt_file]:
+                merged = sections.merge_parts(part_outputs.pop(txt_file))
+
+                if use_rules:
+                    merged = rules.combine(merged, rule_results.pop(txt_file))
+
+                if n_samples > 1:
+                    merged = voting.add_agreement(merged, agreement.pop(txt_file), n_drawn.pop(txt_file))
+
+                prompts_used, completions_used = zip(*used.pop(txt_file))
+                results.append(output_row(txt_file, key, merged, prompts_used, completions_used, config_digest))
+
+        with timer.stage("write"):
+            write_batch(results, output_path, manifest_path, f"{run_id}-{batch_index:05d}")
+
+            if record_path is not None:
+                backends.record(Path(record_path), prompts, completions)
+
+        for (txt_file, _, prompt, part), completion in zip(batch, completions):
+            report_metrics.append({
+                "filename": txt_file.stem + ".json",
+                "part": part[0] if part is not None else None,
+                "samples": prompt.n,
+                "batch": batch_index,
+                "batch_size": len(batch),
+                "batch_seconds": batch_seconds,
+                "prompt_tokens": completion.prompt_tokens,
+                "output_tokens": completion.output_tokens,
+                "finish_reason": completion.finish_reason,
+                "latency": completion.latency,
+                "time_to_first_token": completion.time_to_first_token,
+            })
+
+        n_reports += len(results)
+        n_prompt_tokens += sum(completion.prompt_tokens for completion in completions)
+        n_output_tokens += sum(completion.output_tokens for completion in completions)
+        elapsed = time.perf_counter() - start
+
+        print(
+            f"{n_reports}/{n_to_write} reports, batch of {len(batch)} prompts: "
+            f"{n_reports / elapsed:.2f} reports/s, "
+            f"{n_prompt_tokens / elapsed:.0f} prompt tokens/s, "
+            f"{n_output_tokens / elapsed:.0f} generated tokens/s"
+        )
+
+    if n_samples > 1:
+        print(
+            f"{len(resample)} of {len(items)} prompts did not agree in their first {first_samples} samples "
+            f"and were sampled up to {n_samples} times"
+        )
+
+    if backend_name == "replay":
+        print(f"{backend.misses} prompts had no recording and got an all-null Report")
+
+    with open(runs_path, "a", encoding="utf-8") as f:
+        run = {
+            "config": config_digest,
+            "model": model_id,
+            "shard": f"{shard_index + 1}/{num_shards}",
+            "backend": backend_name,
+            "n_gpus": tensor_parallel_size if backend_name == "vllm" else 0,
+            "n_reports": n_reports,
+            "prompt_tokens": n_prompt_tokens,
+            "output_tokens": n_output_tokens,
+            "seconds": time.perf_counter() - start,
+        }
+        f.write(json.dumps(run) + "\n")
+
+    report_metrics = pl.DataFrame(
+        report_metrics,
+        schema={
+            "filename": pl.String, "part": pl.String, "samples": pl.Int64, "batch": pl.Int64, "batch_size": pl.Int64, "batch_seconds": pl.Float64,
+            "prompt_tokens": pl.Int64, "output_tokens": pl.Int64, "finish_reason": pl.String,
+            "latency": pl.Float64, "time_to_first_token": pl.Float64,
+        },
+    )
+
+    n_truncated = report_metrics.filter(pl.col("finish_reason") == "length").height
+    print(
+        f"{n_truncated} of {report_metrics.height} outputs were cut at max_tokens "
+        f"({sampling_config['max_tokens']}), max_model_len is {max_model_len}"
     )
+    metrics.print_distribution(report_metrics, ["prompt_tokens", "output_tokens", "latency", "time_to_first_token"])
+
+    metrics.write_metrics("extraction", run_id, report_metrics, timer)
 
-    for txt_file, output in zip(batch, outputs):
 
-        with open(output_path / (txt_file.stem + ".json"), "w") as outfile:
-            outfile.write(output.outputs[0].text.strip())
+if __name__ == "__main__":
+    main()
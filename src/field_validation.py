@@ -0,0 +1,122 @@
+# Field-level validation of model outputs against a pydantic model.
+#
+# Validating the whole Report and nulling every field in e.errors() throws away too much:
+# one bad medication nulls the whole list, and the model then has to be validated again.
+# FieldValidator compiles one TypeAdapter per field of the model once, validates each
+# field exactly once, and on failure keeps whatever can be kept:
+#   - list fields keep their valid elements and drop the invalid ones
+#   - nested models (src/archive/nbse_report_schema.py) are cleaned field by field
+#   - anything else is set to None
+# Every problem is recorded as one row of a structured error table.
+
+from typing import Annotated, Type, Union, get_args, get_origin
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+
+def list_item_type(annotation):
+    """Item type of a list annotation, e.g. str for Union[List[str], None]. None if not a list."""
+    if get_origin(annotation) is list:
+        return get_args(annotation)[0]
+
+    if get_origin(annotation) is Union:
+        for arg in get_args(annotation):
+            if get_origin(arg) is list:
+                return get_args(arg)[0]
+
+    return None
+
+
+def nested_model(annotation) -> Type[BaseModel] | None:
+    """The BaseModel subclass of a nested model annotation, e.g. MocaTest. None if not a model."""
+    candidates = get_args(annotation) if get_origin(annotation) is Union else (annotation,)
+
+    for arg in candidates:
+        if isinstance(arg, type) and issubclass(arg, BaseModel):
+            return arg
+
+    return None
+
+
+def error_rows(path: str, e: ValidationError) -> list[dict]:
+    """Flatten a ValidationError into error table rows, with locations relative to path."""
+    rows = []
+
+    for error in e.errors():
+        loc = path + "".join(f"[{part}]" if isinstance(part, int) else f".{part}" for part in error["loc"])
+        rows.append({"field": loc, "type": error["type"], "message": error["msg"], "input": repr(error["input"])})
+
+    return rows
+
+
+class FieldValidator:
+    """Validate each field of a pydantic model on its own. Build once per model and reuse."""
+
+    def __init__(self, model: Type[BaseModel]):
+        self.model = model
+        self.fields = {}
+
+        for name, info in model.model_fields.items():
+            if info.metadata:
+                adapter = TypeAdapter(Annotated[info.annotation, *info.metadata])
+            else:
+                adapter = TypeAdapter(info.annotation)
+
+            item_type = list_item_type(info.annotation)
+            item_adapter = TypeAdapter(item_type) if item_type is not None else None
+
+            submodel = nested_model(info.annotation)
+            sub_validator = FieldValidator(submodel) if submodel is not None else None
+
+            self.fields[name] = (info, adapter, item_adapter, sub_validator)
+
+    def validate(self, data: dict, path: str = "") -> tuple[BaseModel, list[dict]]:
+        """
+        Returns the model instance, built without validating again, and a list of
+        {"field", "type", "message", "input"} rows, one for each invalid value.
+        """
+        values = {}
+        errors = []
+
+        for name, (info, adapter, item_adapter, sub_validator) in self.fields.items():
+            field_path = f"{path}.{name}" if path else name
+
+            if name not in data:
+                if info.is_required():
+                    errors.append({"field": field_path, "type": "missing", "message": "Field required", "input": None})
+                    values[name] = None
+                else:
+                    values[name] = info.get_default(call_default_factory=True)
+                continue
+
+            value = data[name]
+
+            try:
+                values[name] = adapter.validate_python(value)
+
+            except ValidationError as e:
+
+                if sub_validator is not None and isinstance(value, dict):
+                    values[name], sub_errors = sub_validator.validate(value, field_path)
+                    errors.extend(sub_errors)
+
+                elif item_adapter is not None and isinstance(value, list):
+                    values[name] = []
+                    for i, item in enumerate(value):
+                        try:
+                            values[name].append(item_adapter.validate_python(item))
+                        except ValidationError as item_error:
+                            errors.extend(error_rows(f"{field_path}[{i}]", item_error))
+
+                    # constraints on the list itself, if any, must still hold
+                    try:
+                        values[name] = adapter.validate_python(values[name])
+                    except ValidationError as list_error:
+                        values[name] = None
+                        errors.extend(error_rows(field_path, list_error))
+
+                else:
+                    values[name] = None
+                    errors.extend(error_rows(field_path, e))
+
+        return self.model.model_construct(**values), errors
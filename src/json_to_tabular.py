@@ -1,26 +1,44 @@
-import sys
-
-sys.path.append("/projectnb/vkolagrp/bellitti/clinicalnotes-databasing-validated/src")
-
 from pathlib import Path
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel
 from tqdm import tqdm
 import json_repair
 
 import polars as pl
 
-from pydantic import BaseModel, ConfigDict
 import json
 from nbse_report_schema_minimal import Report
+from field_validation import FieldValidator
+from config import config
+import metrics
+import outputs
+from report_files import extract_id
 
 from typing import Type
 import re
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+# the outputs dataset of extract_tabular.py is in here, see outputs.py
+json_dir = Path(config.paths.extracted_dir)
+
+log_file = Path(config.paths.logs_dir) / "validation_failures.log"
+
+# one row per invalid value: filename, field, type, message, input
+errors_file = Path(config.paths.logs_dir) / "validation_errors.parquet"
 
-base_path = Path("/projectnb/vkolagrp/bellitti/clinicalnotes-databasing-validated/")
+# On SGE use the cores requested with -pe omp
+n_workers = int(os.environ.get("NSLOTS", os.cpu_count()))
 
-json_dir = base_path / "results/tabular_extracted_smaller"
 
-log_file = base_path / "logs/validation_failures.log"
+def write_log(line: str, log: list[str] | None = None):
+    """Collect a log line in memory if a list is given, otherwise append it to the log file."""
+    if log is not None:
+        log.append(line)
+    else:
+        with log_file.open("a", encoding="utf-8") as f:
+            f.write(line + "\n")
 
 
 def remove_think_content(text: str) -> str:
@@ -34,112 +52,216 @@ def remove_think_content(text: str) -> str:
     return pattern.sub("", text)
 
 
+FENCE_LINE = re.compile(r"^.*```.*$\n?", re.MULTILINE)
+
+
 def remove_triple_backtick_lines(text: str) -> str:
     """
     Remove lines that contain three backticks, which is how Qwen marks that it is producing code.
     Useful to make parsing into a python dictionary easier.
     """
-    lines = text.splitlines()
-    cleaned = [line for line in lines if "```" not in line]
-    return "\n".join(cleaned)
+    return FENCE_LINE.sub("", text)
+
+
+# one compiled FieldValidator per model, built on first use
+field_validators = {}
 
 
-def validate_and_clean_data(data: dict, model: Type[BaseModel]) -> dict:
+def validate_and_clean_data(
+    data: dict,
+    model: Type[BaseModel],
+    log: list[str] | None = None,
+    errors: list[dict] | None = None,
+) -> BaseModel:
     """
-    Validates a dictionary against a Pydantic model and sets invalid fields to None.
+    Validates a dictionary against a Pydantic model field by field. Invalid fields are set
+    to None, invalid elements of list fields are dropped, nested models are cleaned recursively.
 
     Args:
         data (dict): The dictionary containing the data to validate.
         model (Type[BaseModel]): The Pydantic BaseModel to validate against.
+        log (list[str] | None): Collect log lines here instead of writing them to the log file.
+        errors (list[dict] | None): If given, one {"field", "type", "message", "input"} row per invalid value is appended.
 
     Returns:
-        dict: The modified dictionary with invalid fields set to None.
+        BaseModel: The model instance with the invalid values removed.
     """
-    
-    cleaned_data = (
-        data.copy()
-    )  # Create a copy to avoid modifying the original dict during iteration
 
-    try:
-        return model.model_validate(cleaned_data)
+    if model not in field_validators:
+        field_validators[model] = FieldValidator(model)
+
+    result, field_errors = field_validators[model].validate(data)
 
-    except ValidationError as e:
-        # Iterate over each validation error to find the field name
-        for error in e.errors():
-            field_name = error["loc"][0]
-            cleaned_data[field_name] = None
+    for error in field_errors:
+        write_log(f"  -> Invalid field: '{error['field']}' ({error['message']}). Removed.", log)
 
-            with log_file.open("a", encoding="utf-8") as log:
-                log.write(f"  -> Invalid field: '{field_name}'. Setting to None.\n")
+    if errors is not None:
+        errors.extend(field_errors)
 
-        return model.model_validate(cleaned_data)
+    return result
 
 
-def load_json(file_path: Path) -> BaseModel | None:
+def parse_json(text: str) -> tuple[object, str]:
+    """
+    Parse model output, trying the cheapest strategy first. Returns the parsed value and
+    which tier succeeded:
+        "strict": valid JSON as is (always the case with guided decoding)
+        "fences": valid JSON once the ``` lines are removed
+        "repair": needed json_repair, which always outputs something, it might still not comply with the schema
+    """
     try:
-        with open(file_path) as FILE:
+        return json.loads(text), "strict"
+    except json.JSONDecodeError:
+        pass
+
+    # text = remove_think_content(text)
+    text = remove_triple_backtick_lines(text)
 
-            text = FILE.read()
+    try:
+        return json.loads(text), "fences"
+    except json.JSONDecodeError:
+        pass
 
-            # text = remove_think_content(text)
-            text = remove_triple_backtick_lines(text)
+    return json_repair.loads(text), "repair"
 
-            text = json_repair.loads(text) # this always outputs valid json, it might still not comply with the schema
-            # text = json.loads(
-                # text
-            # )  # this always outputs valid json, it might still not comply with the schema
 
-            return text
+def parse_output(filename: str, text: str | None, log: list[str] | None = None) -> tuple[dict | None, str]:
+    """Parse an output, returning the parsed value and the parse_json tier ("failed" on errors or without output)."""
+    try:
+        return parse_json(text)
 
     except Exception as e:
-        with log_file.open("a", encoding="utf-8") as log:
-            log.write(f"{file_path.name}: {e}\n")
+        write_log(f"{filename}: {e}", log)
 
-        return None
+        return None, "failed"
 
 
-def extract_id(s) -> int:
-    # Extract VAC from string
-    match = re.search(r"VAC[ _\.]*(\d+)", s)
+def process_output(filename: str, text: str | None) -> tuple[dict | None, list[str], list[dict], str, dict]:
+    """
+    Parse, repair, validate and clean the output of a single report.
+    Runs in a worker process, so the log lines and errors are returned instead of written,
+    together with the time spent parsing (and repairing) and validating.
+    """
+    log = [filename]
+    errors = []
 
-    if match is None:
-        raise ValueError(f"Could not match ID from filename {s}")
-    else:
-        return int(match.group(1))
+    start = time.perf_counter()
+    result, tier = parse_output(filename, text, log)
+    parsed = time.perf_counter()
+
+    timing = {"filename": filename, "tier": tier, "parse_seconds": parsed - start, "validate_seconds": None, "n_errors": 0}
+
+    if result is None:
+        return None, log, errors, tier, timing
+
+    if not isinstance(result, dict):
+        # e.g. a list or a string, json_repair parses almost anything
+        write_log(f"  -> Output is a {type(result).__name__}, not a JSON object. Skipped.", log)
+        return None, log, errors, tier, timing
+
+    # where the values come from (rules, ...), written by extract_tabular.py next to the fields
+    meta = result.get("_meta")
+
+    result = validate_and_clean_data(result, Report, log, errors)
+
+    timing["validate_seconds"] = time.perf_counter() - parsed
+    timing["n_errors"] = len(errors)
+
+    for error in errors:
+        error["filename"] = filename
+
+    row = result.model_dump()
+
+    row["filename"] = filename
+
+    row["VAC"] = extract_id(filename)
+
+    row["extraction_meta"] = json.dumps(meta) if meta is not None else None
+
+    return row, log, errors, tier, timing
+
+
+def process_file(jsonfile: Path) -> tuple[dict | None, list[str], list[dict], str, dict]:
+    """process_output of a file in the per-file layout, see outputs.py --export-json."""
+    text = jsonfile.read_text(encoding="utf-8") if jsonfile.exists() else None
+    return process_output(jsonfile.name, text)
 
 
 def main():
 
-    results = []
+    timer = metrics.StageTimer()
+
+    # the latest output of every report, in one scan
+    with timer.stage("scan"):
+        stored = outputs.scan(json_dir).select("filename", "text").collect()
+
+    # one list per output column, filled as the workers return
+    columns = {name: [] for name in Report.model_fields}
+    columns["filename"] = []
+    columns["VAC"] = []
+    columns["extraction_meta"] = []
+
+    log_lines = []
+    error_rows = []
+    parse_tiers = Counter()
+    timings = []
+
+    with timer.stage("process"), ProcessPoolExecutor(n_workers) as pool:
+
+        for filename, (row, log, errors, tier, timing) in tqdm(
+            zip(stored["filename"], pool.map(process_output, stored["filename"].to_list(), stored["text"].to_list(), chunksize=64)),
+            total=stored.height,
+        ):
+            log_lines.extend(log)
+            error_rows.extend(errors)
+            parse_tiers[tier] += 1
+            timings.append(timing)
+
+            if row is None:
+                print(f"No usable output for {filename}")
+                continue
 
-    for jsonfile in tqdm(list(json_dir.glob("*.json"))):
+            for name, values in columns.items():
+                values.append(row[name])
 
-        with log_file.open("a", encoding="utf-8") as log:
-            log.write(f"{jsonfile.name}\n")
+    summary = ", ".join(f"{tier}: {n}" for tier, n in parse_tiers.most_common())
+    print(f"Parsed files by tier: {summary}")
+    log_lines.append(f"Parsed files by tier: {summary}")
 
-        result = load_json(jsonfile)
+    with timer.stage("write_logs"):
+        with log_file.open("a", encoding="utf-8") as f:
+            f.write("\n".join(log_lines) + "\n")
 
-        if result is None:
-            print(f"Empty file {jsonfile}")
-            continue
+        pl.DataFrame(
+            error_rows,
+            schema={"filename": pl.String, "field": pl.String, "type": pl.String, "message": pl.String, "input": pl.String},
+        ).write_parquet(errors_file)
 
-        result = validate_and_clean_data(result, Report)
+    with timer.stage("build_table"):
+        df = pl.DataFrame(columns)
 
-        result = result.model_dump()
+        df = df.with_columns(
+            pl.col("completed").cast(pl.Date),
+            pl.col("extraction_meta").cast(pl.String),
+        ).drop('vac') # overwrite extracted vac column with one parsed by the filename
 
-        result["filename"] = jsonfile.name
-        
-        result["VAC"] = extract_id(jsonfile.name)
+    with timer.stage("write_table"):
+        df.write_parquet(config.paths.tabulated)
 
-        results.append(result)
+    timings = pl.DataFrame(
+        timings,
+        schema={"filename": pl.String, "tier": pl.String, "parse_seconds": pl.Float64, "validate_seconds": pl.Float64, "n_errors": pl.Int64},
+    )
 
-    df = pl.DataFrame(results)
+    # summed over the workers, so this is CPU time rather than wall time
+    print(
+        f"Time in the workers: parsing {timings['parse_seconds'].sum():.2f} s, "
+        f"validating {timings['validate_seconds'].sum():.2f} s, {n_workers} workers"
+    )
+    metrics.print_distribution(timings, ["parse_seconds", "validate_seconds"])
 
-    df = df.with_columns(
-        pl.col("completed").cast(pl.Date),
-    ).drop('vac') # overwrite extracted vac column with one parsed by the filename
+    metrics.write_metrics("tabulation", metrics.new_run_id(), timings, timer)
 
-    df.write_parquet(base_path/"results/NBSE_tabulated.parquet")
 
 if __name__ == "__main__":
     main()
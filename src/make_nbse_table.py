@@ -2,18 +2,42 @@
 # put them in a single table with these columns:
 #
 # VAC: int
-# filename: name of txt file 
+# filename: name of txt file
 # full_text: full text of the report
 # nchars: length of the report, number of characters
-
+# mtime_ns, size: modification time and size in bytes of the file when it was read
+# sha256: hash of full_text
+#
+# The table is written one row group at a time, sorted by VAC, so neither the reports
+# nor the table are ever in memory all at once, and the row group statistics on VAC
+# let scans with a filter on VAC skip most of the file. Files are read in parallel.
+#
+# If the table already exists only new files, and files whose mtime or size changed
+# and whose content hash is different, are read again; the text of every other report
+# is copied from the old table. Reports whose file was deleted are dropped. The update
+# is not an append: the whole table is written again to a temporary file, which
+# replaces the old one at the end, so it stays one file sorted by VAC. Only the
+# reading of the unchanged reports is saved.
+
+import hashlib
+import os
 import re
-import polars as pl
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+
+import polars as pl
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
-base_path = Path('/projectnb/vkolagrp/bellitti/clinicalnotes-databasing-validated')
+from config import config
 
-txt_dir = base_path / 'data/NBSE_txt'
+txt_dir = Path(config.paths.txt_dir)
+output_path = Path(config.paths.full_reports)
+
+# reports per row group, also the number of reports held in memory at a time
+row_group_size = 2048
+n_threads = 16
+compression = "zstd"
 
 
 def extract_id(s) -> int:
@@ -25,25 +49,122 @@ def extract_id(s) -> int:
     else:
         return int(match.group(1))
 
-nbse = []
 
-for filename in tqdm(txt_dir.glob('*.txt')):
+def read_report(path: Path) -> dict:
+    # text mode, so CRLF line endings become \n as they always did
+    full_text = path.read_text(encoding="utf-8")
+
+    return {
+        "filename": path.name,
+        "full_text": full_text,
+        "nchars": len(full_text),
+        "sha256": hashlib.sha256(full_text.encode("utf-8")).hexdigest(),
+    }
+
+
+def list_files() -> pl.DataFrame:
+    """VAC, filename, mtime_ns and size of every txt file, sorted by VAC."""
+    rows = []
+
+    for path in txt_dir.glob("*.txt"):
+        stat = path.stat()
+        rows.append({"VAC": extract_id(path.stem), "filename": path.name, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size})
+
+    return pl.DataFrame(
+        rows, schema={"VAC": pl.Int64, "filename": pl.String, "mtime_ns": pl.Int64, "size": pl.Int64}
+    ).sort("VAC", "filename")
+
+
+def load_index() -> pl.DataFrame | None:
+    """filename, mtime_ns, size and sha256 of the reports already in the table, if any."""
+    if not output_path.exists():
+        return None
+
+    columns = pq.read_schema(output_path).names
+    if "sha256" not in columns or "size" not in columns:
+        # table written before hashes and sizes were stored: read everything again
+        return None
+
+    return pl.scan_parquet(output_path).select("filename", "mtime_ns", "size", "sha256").collect()
+
+
+def main():
+    files = list_files()
+    index = load_index()
+
+    if index is None:
+        files = files.with_columns(unchanged=pl.lit(False))
+    else:
+        files = files.join(
+            index.rename({"mtime_ns": "old_mtime_ns", "size": "old_size"}), on="filename", how="left", maintain_order="left"
+        ).with_columns(
+            # new files have no old mtime, the comparison is null for them
+            unchanged=((pl.col("mtime_ns") == pl.col("old_mtime_ns")) & (pl.col("size") == pl.col("old_size"))).fill_null(False)
+        ).drop("old_mtime_ns", "old_size")
+
+    n_unchanged = files["unchanged"].sum()
+    print(f"{len(files)} reports, {n_unchanged} unchanged, {len(files) - n_unchanged} to read")
+
+    if index is not None and n_unchanged == len(files) and len(index) == len(files):
+        print("Nothing to do")
+        return
+
+    tmp_path = output_path.with_suffix(".tmp.parquet")
+    writer = None
+    n_rehashed = 0
+
+    with ThreadPoolExecutor(n_threads) as pool:
+
+        for chunk in tqdm(files.iter_slices(row_group_size), total=-(-len(files) // row_group_size)):
+
+            to_read = chunk.filter(~pl.col("unchanged"))
+            read = pl.DataFrame(
+                list(pool.map(read_report, [txt_dir / f for f in to_read["filename"]])),
+                schema={"filename": pl.String, "full_text": pl.String, "nchars": pl.Int64, "sha256": pl.String},
+            )
+
+            if index is not None:
+                # files that were touched but whose content is the same count as unchanged
+                n_rehashed += read.join(index, on=["filename", "sha256"], how="semi").height
+
+            kept = chunk.filter(pl.col("unchanged"))["filename"]
+            if len(kept):
+                # the old table is sorted by VAC as well, so this only reads the matching row groups
+                copied = (
+                    pl.scan_parquet(output_path)
+                    .filter(pl.col("VAC").is_between(chunk["VAC"].min(), chunk["VAC"].max()))
+                    .filter(pl.col("filename").is_in(kept.implode()))
+                    .select("filename", "full_text", "nchars", "sha256")
+                    .collect()
+                )
+                read = pl.concat([read, copied])
+
+            table = (
+                chunk.select("VAC", "filename", "mtime_ns", "size")
+                .join(read, on="filename", how="left", maintain_order="left")
+                .select("VAC", "filename", "full_text", "nchars", "mtime_ns", "size", "sha256")
+                .to_arrow()
+            )
+
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema, compression=compression, write_statistics=True)
 
-    case_dict = {}
+            writer.write_table(table, row_group_size=row_group_size)
 
-    vac_id = extract_id(filename.stem)
+    if writer is None:
+        print("No reports found")
+        return
 
-    case_dict['VAC'] = vac_id
+    writer.close()
 
-    case_dict['filename'] = filename.name
+    # the old table was being read until now, replace it only at the end
+    os.replace(tmp_path, output_path)
 
-    with open(filename) as f:
-        case_dict['full_text'] = f.read()
-    
-    case_dict['nchars'] = len(case_dict['full_text'])
+    if index is not None:
+        print(f"{n_rehashed} of the files read had not changed since the last run")
 
-    nbse.append(case_dict)
+    print(f"Wrote {len(files)} reports to {output_path}")
 
-nbse_df = pl.DataFrame(nbse).sort('VAC')
 
-nbse_df.write_parquet(base_path / 'results/full_reports.parquet')
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Run after all the array tasks of a sharded extract_tabular.sh job have finished.
+#
+# Checks that every report in the corpus was extracted exactly once with the current
+# configuration (prompt, schema, model, sampling parameters), then combines the
+# per-shard manifests into a single manifest.jsonl, appending only the entries it does not
+# have yet.
+#
+# Exits with a non-zero status, without touching the manifests, if anything is missing.
+
+import json
+import sys
+from collections import defaultdict
+
+from nbse_report_schema_minimal import Report
+import extract_tabular as et
+import outputs
+from report_files import load_manifest
+
+
+def main():
+    schema = Report.model_json_schema()
+    config_digest = et.run_config_digest(schema)
+
+    shard_manifests = sorted(et.output_path.glob("manifest.shard*.jsonl"))
+
+    # which shard manifests list each output file
+    seen_in = defaultdict(list)
+
+    # reports extracted by earlier runs are not extracted again, so they are only listed here
+    existing = load_manifest(et.output_path / "manifest.jsonl")
+    merged = dict(existing)
+
+    for path in shard_manifests:
+        for filename, key in load_manifest(path).items():
+            seen_in[filename].append(path.name)
+            merged[filename] = key
+
+    stored = set(outputs.scan(et.output_path).select("filename").collect()["filename"])
+
+    missing = []
+    stale = []
+
+    for txt_file in sorted(et.txt_path.glob("*.txt")):
+        filename = txt_file.stem + ".json"
+        expected = et.extraction_key(txt_file.read_text(encoding="utf-8"), config_digest)
+
+        if filename not in merged or filename not in stored:
+            missing.append(filename)
+        elif merged[filename] != expected:
+            stale.append(filename)
+
+    duplicated = {f: shards for f, shards in seen_in.items() if len(shards) > 1}
+
+    print(f"{len(shard_manifests)} shard manifests, {len(merged)} extracted reports in total")
+    print(f"missing: {len(missing)}, stale: {len(stale)}, in more than one shard: {len(duplicated)}")
+
+    for filename in missing:
+        print(f"  missing: {filename}")
+    for filename in stale:
+        print(f"  stale: {filename}")
+    for filename, shards in duplicated.items():
+        print(f"  duplicated: {filename} in {', '.join(shards)}")
+
+    if missing or stale or duplicated:
+        sys.exit(1)
+
+    # only what the shards added or changed, the rest is in manifest.jsonl already
+    new = {filename: key for filename, key in merged.items() if existing.get(filename) != key}
+
+    with open(et.output_path / "manifest.jsonl", "a", encoding="utf-8") as manifest:
+        for filename, key in new.items():
+            manifest.write(json.dumps({"file": filename, "key": key}) + "\n")
+
+    print(f"Added {len(new)} entries to manifest.jsonl")
+
+    for path in shard_manifests:
+        path.unlink()
+
+
+if __name__ == "__main__":
+    main()
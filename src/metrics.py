@@ -0,0 +1,82 @@
+# Where the time goes in extract_tabular.py and json_to_tabular.py.
+#
+# Each run writes two Parquet tables to paths.metrics_dir, named after the script and the run:
+#   <name>_reports_<run>.parquet  one row per report (tokens, latency, finish reason, ...)
+#   <name>_stages_<run>.parquet   wall time of each stage of the run
+# and prints a summary at the end. To look at all the runs of a script at once:
+#   pl.scan_parquet(metrics_dir / "extraction_reports_*.parquet")
+
+import os
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+import polars as pl
+
+from config import config
+
+metrics_dir = Path(config.paths.metrics_dir)
+
+
+def new_run_id(suffix: str = "") -> str:
+    return time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}" + suffix
+
+
+class StageTimer:
+    """Accumulate wall time per stage: with timer.stage("write"): ..."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def table(self) -> pl.DataFrame:
+        total = time.perf_counter() - self.start
+        stages = list(self.seconds) + ["other"]
+        seconds = list(self.seconds.values()) + [max(total - sum(self.seconds.values()), 0.0)]
+
+        return pl.DataFrame(
+            {
+                "stage": stages,
+                "calls": [self.calls[s] for s in stages],
+                "seconds": seconds,
+                "fraction": [s / total if total else None for s in seconds],
+            },
+            schema={"stage": pl.String, "calls": pl.Int64, "seconds": pl.Float64, "fraction": pl.Float64},
+        )
+
+
+def write_metrics(name: str, run_id: str, reports: pl.DataFrame, timer: StageTimer):
+    """Write both tables of a run and print the stage times."""
+    metrics_dir.mkdir(parents=True, exist_ok=True)
+
+    stages = timer.table()
+
+    reports.write_parquet(metrics_dir / f"{name}_reports_{run_id}.parquet")
+    stages.write_parquet(metrics_dir / f"{name}_stages_{run_id}.parquet")
+
+    print(f"Stage wall times ({name}, run {run_id}):")
+    for stage, calls, seconds, fraction in stages.iter_rows():
+        print(f"  {stage:<14} {seconds:10.3f} s {fraction or 0:7.1%}  ({calls} calls)")
+
+
+def print_distribution(reports: pl.DataFrame, columns: list[str]):
+    """Percentiles of some numeric columns of the reports table, e.g. token counts."""
+    for col in columns:
+        values = reports[col].drop_nulls()
+        if values.is_empty():
+            continue
+        print(
+            f"  {col:<20} p50 {values.quantile(0.5):10.4g}  p95 {values.quantile(0.95):10.4g}  "
+            f"p99 {values.quantile(0.99):10.4g}  max {values.max():10.4g}"
+        )
@@ -0,0 +1,144 @@
+# Raw outputs of extract_tabular.py, stored as a Parquet dataset rather than one small .json
+# file per report: every written batch is one file in <extracted dir>/outputs/, with one row
+# per report:
+#   filename       <report>.json, the file name of the per-file layout, identifies the report
+#   VAC
+#   key            manifest key, hash of the report text and of the run configuration
+#   config         hash of the run configuration
+#   model
+#   prompt_hash    sha256 of the prompt, or of the hashes of all the prompts of the report
+#   prompt_tokens  summed over the prompts (sections, samples) of the report
+#   output_tokens
+#   finish_reason  "length" if any output was cut at max_tokens
+#   text           raw output, merged over the sections with chunking
+#   written        when the batch was written
+# A report that is extracted again gets a new row, the latest one wins. Files are written
+# under a temporary name and renamed, so readers never see a partially written batch.
+#
+# The per-file layout is available as an export, and outputs of older runs can be imported:
+#   uv run src/outputs.py --export-json   # write <extracted dir>/<report>.json for every report
+#   uv run src/outputs.py --import-json   # add the <report>.json files of older runs to the dataset
+
+import argparse
+import os
+from datetime import datetime
+from pathlib import Path
+
+import polars as pl
+
+from config import config
+from report_files import extract_id, load_manifest
+
+SCHEMA = {
+    "filename": pl.String,
+    "VAC": pl.Int64,
+    "key": pl.String,
+    "config": pl.String,
+    "model": pl.String,
+    "prompt_hash": pl.String,
+    "prompt_tokens": pl.Int64,
+    "output_tokens": pl.Int64,
+    "finish_reason": pl.String,
+    "text": pl.String,
+    "written": pl.Datetime("us"),
+}
+
+
+def dataset_dir(out_dir: Path) -> Path:
+    return out_dir / "outputs"
+
+
+def write(rows: list[dict], out_dir: Path, name: str):
+    """Write a batch of rows as one file of the dataset, written is now unless a row has it."""
+    if not rows:
+        return
+
+    directory = dataset_dir(out_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    written = datetime.now()
+    df = pl.DataFrame([{"written": written} | row for row in rows], schema=SCHEMA)
+
+    tmp = directory / f"{name}.parquet.tmp"
+    df.write_parquet(tmp)
+
+    with open(tmp, "rb+") as f:
+        os.fsync(f.fileno())
+
+    os.replace(tmp, directory / f"{name}.parquet")
+
+
+def scan(out_dir: Path) -> pl.LazyFrame:
+    """The latest output of every report, in one scan of the whole dataset."""
+    files = sorted(dataset_dir(out_dir).glob("*.parquet"))
+
+    if not files:
+        return pl.LazyFrame(schema=SCHEMA)
+
+    return (
+        pl.scan_parquet(files)
+        .sort("written", maintain_order=True)
+        .unique("filename", keep="last", maintain_order=True)
+    )
+
+
+def read_texts(out_dir: Path) -> dict[str, str]:
+    """{filename: raw output} of every report."""
+    df = scan(out_dir).select("filename", "text").collect()
+    return dict(zip(df["filename"], df["text"]))
+
+
+def export_json(out_dir: Path):
+    """Write the latest output of every report to <out_dir>/<filename>, the per-file layout."""
+    for filename, text in read_texts(out_dir).items():
+        tmp = out_dir / (filename + ".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, out_dir / filename)
+
+
+def import_json(out_dir: Path, manifest: dict[str, str]):
+    """
+    Add the .json files of out_dir to the dataset, with their manifest keys and modification
+    times. Token counts and run metadata are unknown, so reports already in the dataset are
+    skipped rather than given a newer row without them (e.g. the files of --export-json).
+    """
+    stored = set(scan(out_dir).select("filename").collect()["filename"])
+    json_files = sorted(out_dir.glob("*.json"))
+
+    rows = [
+        {
+            "filename": json_file.name,
+            "VAC": extract_id(json_file.stem),
+            "key": manifest.get(json_file.name),
+            "text": json_file.read_text(encoding="utf-8"),
+            "written": datetime.fromtimestamp(json_file.stat().st_mtime),
+        }
+        for json_file in json_files
+        if json_file.name not in stored
+    ]
+
+    write(rows, out_dir, "imported-" + datetime.now().strftime("%Y%m%d-%H%M%S"))
+    print(f"Imported {len(rows)} files into {dataset_dir(out_dir)}, {len(json_files) - len(rows)} already there")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert between the outputs dataset and one .json file per report")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--export-json", action="store_true", help="write one .json file per report")
+    group.add_argument("--import-json", action="store_true", help="add the .json files of older runs to the dataset")
+    args = parser.parse_args()
+
+    out_dir = Path(config.paths.extracted_dir)
+
+    if args.export_json:
+        export_json(out_dir)
+    else:
+        manifest = {}
+        for path in sorted(out_dir.glob("manifest*.jsonl")):
+            manifest |= load_manifest(path)
+
+        import_json(out_dir, manifest)
+
+
+if __name__ == "__main__":
+    main()
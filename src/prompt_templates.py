@@ -55,6 +55,29 @@ Neurobehavioral Report:
 
 """
 
+# Used with guided decoding: the output is constrained to the schema by vLLM, so there is
+# no need to ask for valid JSON or wrap the schema in a code block.
+TABULAR_TEMPLATE_GUIDED = """Your task is to convert a Neurobehavioral Report into JSON format. 
+Use null if you cannot safely determine the value of a key.
+Comply with the provided JSON schema. Pay attention to the field descriptions.
+
+Dates will be provided in USA month-first format: mm/dd/yy or mm.dd.yy, convert them to ISO format yyyy-mm-dd
+
+The encounter type is specified at the beginning of the report. If it is missing, use notes and summaries to help you determine the encounter type.
+If you still cannot determine the encounter type, output null.
+
+When reporting medications, only keep medication name and strength, remove origin (e.g. non-va), purpose, and directions about usage.
+
+JSON Schema:
+
+{schema}
+
+Neurobehavioral Report:
+
+{report}
+
+"""
+
 # - If Boston Naming Test (BNT) is present, the encounter type is either in-person or VVC.
 # - If Verbal Naming Test (VNT) is present, the encounter type is telephone.
 # Copy notes and comments from the report exactly as written to the appropriate keys.
\ No newline at end of file
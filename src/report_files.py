@@ -0,0 +1,38 @@
+# Identifying the files of a run: the VAC of a report file name, and the manifest of the
+# reports extracted so far. Shared by extract_tabular.py, json_to_tabular.py and outputs.py,
+# which import this module rather than each other.
+
+import json
+import re
+from pathlib import Path
+
+
+def extract_id(s) -> int:
+    # Extract VAC from string
+    match = re.search(r"VAC[ _\.]*(\d+)", s)
+
+    if match is None:
+        raise ValueError(f"Could not match ID from filename {s}")
+    else:
+        return int(match.group(1))
+
+
+def load_manifest(path: Path) -> dict[str, str]:
+    """
+    Read the manifest into a {json filename: key} dict. Later lines win.
+    A truncated last line (job killed mid-write) is ignored.
+    """
+    manifest = {}
+
+    if not path.exists():
+        return manifest
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            manifest[entry["file"]] = entry["key"]
+
+    return manifest
@@ -0,0 +1,205 @@
+# Rule-based extraction of the Report fields that are written in templated lines,
+# e.g. "MoCA: 24/30" or "Trails B: 95 seconds, 1 error" (extraction.rules in config.yaml).
+#
+# Every rule is a compiled regex with one group, applied to the whole report. A match is in
+# place if it is in the section of its field (see sections.py), and for the header fields
+# (VAC, date, age, ...) also at the start of a line, like "Age: 78". A field is
+#   high confidence  if all the matches of its rules agree on one valid value, and are in place
+#   low confidence   otherwise, e.g. different values, or "began at age 62" in the history
+# and missing if nothing matches. Values are validated against the Report field, so e.g. a
+# MoCA of 34/30 is not a candidate. Only high confidence fields are taken without asking the
+# model; for low confidence ones the model is asked and its answer compared to the candidates.
+
+import json
+import re
+from datetime import datetime
+from typing import Annotated
+
+from pydantic import TypeAdapter, ValidationError
+
+import sections
+from nbse_report_schema_minimal import Report
+
+FLAGS = re.IGNORECASE
+
+# up to this many characters between a test name and its score, on the same line
+GAP = r"[^\n]{0,40}?"
+
+
+def to_int(s: str) -> int:
+    return int(s)
+
+
+def to_float(s: str) -> float:
+    return float(s)
+
+
+def to_sex(s: str) -> str:
+    return "male" if s.lower().startswith("m") else "female"
+
+
+def to_iso_date(s: str) -> str:
+    s = s.replace(".", "/").replace("-", "/")
+    for fmt in ("%m/%d/%Y", "%m/%d/%y"):
+        try:
+            return datetime.strptime(s, fmt).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"Not a month-first date: {s}")
+
+
+def trails_time(part: str) -> str:
+    return (
+        r"\bTrails?\s*(?:Making\s*)?(?:Test\s*)?(?:Part\s*)?" + part + r"\b" + GAP
+        + r"\b(\d{1,3}(?:\.\d+)?)\s*(?:seconds|secs?\b|s\b|\")"
+    )
+
+
+def score(test: str, out_of: int) -> str:
+    return r"\b(?:" + test + r")\b" + GAP + r"\b(\d{1,2})\s*/\s*" + str(out_of) + r"\b"
+
+
+# field -> (regexes, converter from the matched string)
+RULES = {
+    "vac": ([r"\bVAC[\s_#:\.]*(\d{1,4})\b"], to_int),
+    "completed": (
+        [r"\b(?:date of (?:exam|evaluation|service|visit)|exam date|completed(?: on)?)\s*[:\-]?\s*(\d{1,2}[/.\-]\d{1,2}[/.\-]\d{2,4})\b"],
+        to_iso_date,
+    ),
+    "age": ([r"\bage\s*[:\-]?\s*(\d{2,3})\b", r"\b(\d{2,3})[- ]year[- ]old\b"], to_int),
+    "sex": ([r"\b(?:sex|gender)\s*[:\-]?\s*(male|female|m|f)\b"], to_sex),
+    "education": (
+        [r"\b(\d{1,2})\s*(?:years|yrs)\s*(?:of\s*)?(?:education|school)", r"\beducation\s*[:\-]?\s*(\d{1,2})\b"],
+        to_int,
+    ),
+    "moca_total_score": ([score(r"MoCA|Montreal Cognitive Assessment", 30)], to_int),
+    "mmse_total_score": ([score(r"MMSE|Mini[- ]Mental State(?: Exam(?:ination)?)?", 30)], to_int),
+    "aces_total_score": ([score(r"ACES", 30)], to_int),
+    "cerad_encoding_total": ([score(r"encoding(?: total)?", 30)], to_int),
+    "cerad_delayed_recall": ([score(r"delayed recall", 10)], to_int),
+    "trailsa_time_in_seconds": ([trails_time("A")], to_float),
+    "trailsb_time_in_seconds": ([trails_time("B")], to_float),
+    "boston_naming_total_score": ([score(r"Boston Naming(?: Test)?|BNT", 15)], to_int),
+    "verbal_naming_total_score": ([score(r"Verbal Naming(?: Test)?|VNT", 55)], to_int),
+}
+
+COMPILED = {field: ([re.compile(p, FLAGS) for p in patterns], convert) for field, (patterns, convert) in RULES.items()}
+
+
+def field_adapter(field: str) -> TypeAdapter:
+    """TypeAdapter of a Report field with its constraints, e.g. 0 <= MoCA <= 30."""
+    info = Report.model_fields[field]
+
+    if info.metadata:
+        return TypeAdapter(Annotated[info.annotation, *info.metadata])
+
+    return TypeAdapter(info.annotation)
+
+
+ADAPTERS = {field: field_adapter(field) for field in RULES}
+
+# what may precede a header field on its line, e.g. bullets
+LINE_START = re.compile(r"(?:^|\n)[ \t\-\*]*$")
+
+
+def valid(field: str, value) -> bool:
+    """Whether the value satisfies the type and constraints of the Report field."""
+    try:
+        ADAPTERS[field].validate_python(value)
+    except ValidationError:
+        return False
+
+    return True
+
+
+def in_place(field: str, match: re.Match, text: str, spans: dict[str, tuple[int, int]]) -> bool:
+    """Whether a match is in the section of its field, and at the start of a line for header fields."""
+    home = sections.HOME[field]
+
+    if home not in spans:
+        return False
+
+    start, end = spans[home]
+    if not start <= match.start() < end:
+        return False
+
+    return home != "header" or LINE_START.search(text, 0, match.start()) is not None
+
+
+def extract_rules(text: str) -> dict[str, dict]:
+    """{field: {"value", "confidence", "candidates"}} of every field some rule matched with a valid value."""
+    spans = sections.section_spans(text)
+    results = {}
+
+    for field, (patterns, convert) in COMPILED.items():
+        candidates = []
+        all_in_place = True
+
+        for pattern in patterns:
+            for match in pattern.finditer(text):
+                try:
+                    value = convert(match.group(1))
+                except ValueError:
+                    continue
+
+                if not valid(field, value):
+                    continue
+
+                all_in_place &= in_place(field, match, text, spans)
+
+                if value not in candidates:
+                    candidates.append(value)
+
+        if len(candidates) == 1 and all_in_place:
+            results[field] = {"value": candidates[0], "confidence": "high", "candidates": candidates}
+        elif candidates:
+            results[field] = {"value": None, "confidence": "low", "candidates": candidates}
+
+    return results
+
+
+def resolved_fields(results: dict[str, dict]) -> set[str]:
+    """Fields the model does not need to be asked for."""
+    return {field for field, result in results.items() if result["confidence"] == "high"}
+
+
+def rules_spec() -> dict:
+    """What determines the rule outputs, for the configuration hash of extract_tabular.py."""
+    return {
+        "rules": {field: patterns for field, (patterns, _) in RULES.items()},
+        # where the matches are decides whether they are taken without the model
+        "sections": sections.section_spec(),
+    }
+
+
+def combine(merged: str, results: dict[str, dict]) -> str:
+    """
+    Add the rule values to the merged model output of a report (see sections.merge_parts),
+    and record under "_meta" where each field with a rule match comes from: "rules" if it was
+    taken without asking the model, "model" otherwise. Fields where the model output is not
+    one of the rule candidates are listed as disagreements, and those the model left null
+    as model_missing.
+    """
+    data = json.loads(merged)
+    fields = {}
+    disagreements = []
+    model_missing = []
+
+    for field, result in results.items():
+        entry = {"confidence": result["confidence"], "candidates": result["candidates"]}
+
+        if result["confidence"] == "high":
+            data[field] = result["value"]
+            entry["source"] = "rules"
+        else:
+            entry["source"] = "model"
+            if data.get(field) is None:
+                model_missing.append(field)
+            elif data[field] not in result["candidates"]:
+                disagreements.append(field)
+
+        fields[field] = entry
+
+    data.setdefault("_meta", {}).update(rules=fields, disagreements=disagreements, model_missing=model_missing)
+
+    return json.dumps(data, indent=2)
@@ -0,0 +1,157 @@
+# Local replacement for the RxNav "approximate term -> ingredients" lookup.
+#
+# Built once from an RxNorm release (https://www.nlm.nih.gov/research/umls/rxnorm/docs/rxnormfiles.html),
+# using the two files in its rrf/ folder:
+#   RXNCONSO.RRF  concept names, one row per name: RXCUI|LAT|TS|LUI|STT|SUI|ISPREF|RXAUI|SAUI|SCUI|SDUI|SAB|TTY|CODE|STR|...
+#   RXNREL.RRF    relations between concepts:      RXCUI1|RXAUI1|STYPE1|REL|RXCUI2|RXAUI2|STYPE2|RELA|...
+#
+# Names are matched with a character trigram TF-IDF index (cosine similarity), all query
+# terms at once with a sparse matrix product. The best matching concept is then mapped to
+# its ingredients (TTY = IN) by walking down the RxNorm concept hierarchy, the same answer
+# as rxcui/{rxcui}/related.json?tty=IN.
+
+import pickle
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+# Which term types to walk to from each term type, on the way down to the ingredients.
+# Relations are followed in both directions, the term types alone decide where to go.
+TOWARDS_INGREDIENT = {
+    "PIN": {"IN"},
+    "MIN": {"IN"},
+    "BN": {"IN"},
+    "SCDC": {"IN"},
+    "SCDF": {"IN"},
+    "SCDFP": {"IN"},
+    "SCDG": {"IN"},
+    "SCDGP": {"IN"},
+    "SCD": {"SCDC"},
+    "SBDC": {"SCDC"},
+    "SBD": {"SCD"},
+    "SBDF": {"SCDF"},
+    "SBDFP": {"SCDF"},
+    "SBDG": {"SCDG"},
+    "GPCK": {"SCD"},
+    "BPCK": {"SCD", "SBD"},
+}
+
+RXNCONSO_COLUMNS = ["RXCUI", "LAT", "TS", "LUI", "STT", "SUI", "ISPREF", "RXAUI", "SAUI",
+                    "SCUI", "SDUI", "SAB", "TTY", "CODE", "STR", "SRL", "SUPPRESS", "CVF"]
+RXNREL_COLUMNS = ["RXCUI1", "RXAUI1", "STYPE1", "REL", "RXCUI2", "RXAUI2", "STYPE2", "RELA",
+                  "RUI", "SRUI", "SAB", "SL", "RG", "DIR", "SUPPRESS", "CVF"]
+
+
+def read_rrf(path: Path, columns: list[str]) -> pl.DataFrame:
+    # every line ends with a trailing "|", hence the extra empty column
+    return pl.read_csv(
+        path,
+        separator="|",
+        has_header=False,
+        new_columns=columns + ["_"],
+        schema_overrides={c: pl.String for c in columns + ["_"]},
+        quote_char=None,
+    ).drop("_")
+
+
+class RxNormIndex:
+    """Fuzzy name -> RxNorm concept -> ingredient names, without any network access."""
+
+    def __init__(self, names: list[str], name_rxcuis: list[str], ingredients: dict[str, list[str]]):
+        self.names = names
+        self.name_rxcuis = name_rxcuis
+        self.ingredients = ingredients
+        self.vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(3, 3), lowercase=True)
+        self.matrix = self.vectorizer.fit_transform(names)
+
+    @classmethod
+    def build(cls, release_path: Path) -> "RxNormIndex":
+        """Build the index from the rrf/ folder of an RxNorm release."""
+        conso = read_rrf(release_path / "RXNCONSO.RRF", RXNCONSO_COLUMNS).filter(
+            (pl.col("SAB") == "RXNORM") & (pl.col("SUPPRESS") == "N")
+        )
+        rel = read_rrf(release_path / "RXNREL.RRF", RXNREL_COLUMNS).filter(
+            (pl.col("SAB") == "RXNORM") & pl.col("RXCUI1").is_not_null() & pl.col("RXCUI2").is_not_null()
+        )
+
+        # a concept also has synonym rows (SY, PSN, TMSY, ET) under its RXCUI, its term type
+        # is the one of its RxNorm name, one of the concept-level term types
+        concept_ttys = list(TOWARDS_INGREDIENT) + ["IN"]
+        tty = dict(conso.filter(pl.col("TTY").is_in(concept_ttys)).select("RXCUI", "TTY").unique("RXCUI").iter_rows())
+        ingredient_names = dict(conso.filter(pl.col("TTY") == "IN").select("RXCUI", "STR").unique("RXCUI").iter_rows())
+
+        neighbours = defaultdict(set)
+        for a, b in rel.select("RXCUI1", "RXCUI2").unique().iter_rows():
+            neighbours[a].add(b)
+            neighbours[b].add(a)
+
+        memo = {}
+
+        def ingredient_cuis(rxcui: str) -> set[str]:
+            if rxcui in memo:
+                return memo[rxcui]
+
+            memo[rxcui] = set()  # guards against cycles
+
+            if tty.get(rxcui) == "IN":
+                found = {rxcui}
+            else:
+                targets = TOWARDS_INGREDIENT.get(tty.get(rxcui), set())
+                found = set()
+                for other in neighbours[rxcui]:
+                    if tty.get(other) in targets:
+                        found |= ingredient_cuis(other)
+
+            memo[rxcui] = found
+            return found
+
+        names = conso.select(pl.col("STR").str.to_lowercase(), "RXCUI").unique("STR", keep="first", maintain_order=True)
+
+        ingredients = {}
+        for rxcui in names["RXCUI"].unique():
+            ingredients[rxcui] = sorted(ingredient_names[i] for i in ingredient_cuis(rxcui))
+
+        return cls(names["STR"].to_list(), names["RXCUI"].to_list(), ingredients)
+
+    def save(self, path: Path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path: Path) -> "RxNormIndex":
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def best_matches(self, search_terms: list[str], min_score: float = 0.5, chunk_size: int = 1000):
+        """
+        (rxcui, score) of the closest name to each term, or (None, score) if nothing is similar enough.
+        Terms are matched chunk_size at a time, each chunk with a single sparse matrix product.
+        """
+        matches = []
+
+        for start in range(0, len(search_terms), chunk_size):
+            queries = self.vectorizer.transform(search_terms[start:start + chunk_size])
+            scores = (queries @ self.matrix.T).tocsr()
+
+            best = np.asarray(scores.argmax(axis=1)).ravel()
+            best_scores = scores[np.arange(len(best)), best].A1
+
+            for i, score in zip(best, best_scores):
+                matches.append((self.name_rxcuis[i] if score >= min_score else None, float(score)))
+
+        return matches
+
+    def lookup_many(self, search_terms: list[str], min_score: float = 0.5) -> dict[str, list[str]]:
+        """{search term: ingredient names}, like standardize_meds.standardize_drug_name for every term."""
+        matches = self.best_matches(search_terms, min_score)
+        return {
+            term: (self.ingredients.get(rxcui, []) if rxcui is not None else [])
+            for term, (rxcui, _) in zip(search_terms, matches)
+        }
+
+    def lookup(self, search_term: str, min_score: float = 0.5) -> list[str]:
+        """Same return type as standardize_meds.standardize_drug_name."""
+        return self.lookup_many([search_term], min_score)[search_term]
@@ -0,0 +1,129 @@
+# Split NBSE reports into their recurring sections, so that each section can be extracted
+# on its own with only the Report fields it can populate (extraction.chunking in config.yaml).
+#
+# A section starts at a line that begins with one of its headings and ends where the next
+# section starts. Everything before the first heading is the header (demographics and
+# encounter type). The fields of sections that are not found in a report are not asked
+# for and stay null: most reports have only one of MoCA, MMSE and ACES, and sending the
+# whole report again for the others would keep the longest prompt of every report as
+# long as without chunking. Only a report without any heading is extracted whole.
+#
+# The model outputs for the sections of a report are merged into a single JSON object with
+# all the Report fields, which json_to_tabular.py validates like any other output.
+
+import json
+import re
+from functools import lru_cache
+
+from pydantic import create_model
+
+from json_to_tabular import parse_json
+from nbse_report_schema_minimal import Report
+
+# section name -> (heading regex, Report fields it can populate), in the usual report order
+SECTIONS = {
+    "header": (None, ["vac", "completed", "age", "sex", "education", "encounter_type"]),
+    "moca": (r"MoCA|Montreal Cognitive", ["moca_total_score"]),
+    "mmse": (r"MMSE|Mini[- ]Mental", ["mmse_total_score"]),
+    "aces": (r"(?:Telephone )?ACES\b", ["aces_total_score"]),
+    "cerad": (r"CERAD|Word List", ["cerad_encoding_total", "cerad_delayed_recall", "cerad_corrected_recognition_total"]),
+    "trails": (r"Trail", ["trailsa_time_in_seconds", "trailsa_errors", "trailsb_time_in_seconds", "trailsb_errors"]),
+    "fluency": (r"(?:Letter |Category |Verbal )?Fluency", ["letter_fluency_total", "category_fluency_total"]),
+    "naming": (r"Boston Naming|BNT\b|Verbal Naming|VNT\b", ["boston_naming_total_score", "verbal_naming_total_score"]),
+    "medications": (r"(?:Current |Active )?Medications?\b", ["medications"]),
+    "summary": (
+        r"Summary|Impression|Recommendations?\b|Assessment\b|Diagnos[ie]s\b",
+        ["adl_impaired", "iadl_impaired", "diagnosis", "clinical_syndrome",
+         "neuropsychological_testing_recommended", "pet_recommended"],
+    ),
+}
+
+# a heading is at the start of a line, possibly after bullets or numbering
+HEADINGS = {
+    name: re.compile(r"^[ \t\-\*\d\.\)]*(?:" + pattern + ")", re.IGNORECASE | re.MULTILINE)
+    for name, (pattern, _) in SECTIONS.items()
+    if pattern is not None
+}
+
+# the whole report, as the single part of a report without any recognizable section
+FALLBACK = "rest"
+
+# field -> the section it is written in
+HOME = {field: name for name, (_, fields) in SECTIONS.items() for field in fields}
+
+
+def section_spans(text: str) -> dict[str, tuple[int, int]]:
+    """{section name: (start, end)} of the sections found in a report, header included."""
+    starts = {}
+
+    for name, heading in HEADINGS.items():
+        matches = list(heading.finditer(text))
+        if matches:
+            # conclusions are at the end, the same words earlier on are usually the history
+            starts[name] = matches[-1].start() if name == "summary" else matches[0].start()
+
+    order = sorted(starts, key=starts.get)
+    first = starts[order[0]] if order else len(text)
+
+    spans = {"header": (0, first)}
+    for name, next_name in zip(order, order[1:] + [None]):
+        end = starts[next_name] if next_name is not None else len(text)
+        spans[name] = (starts[name], end)
+
+    return spans
+
+
+def split_sections(text: str) -> dict[str, str]:
+    """{section name: text} of the sections found in a report, header included."""
+    sections = {name: text[start:end] for name, (start, end) in section_spans(text).items()}
+    return {name: section for name, section in sections.items() if section.strip()}
+
+
+def plan_report(text: str) -> list[tuple[str, str, list[str]]]:
+    """
+    (part name, text, fields) of every prompt needed for a report. Every Report field is in
+    at most one part, the fields of the sections that were not found in none (merge_parts
+    sets them to null). A report without any recognizable section is a single part, the
+    whole report.
+    """
+    sections = split_sections(text)
+
+    if list(sections) == ["header"]:
+        return [(FALLBACK, text, list(Report.model_fields))]
+
+    return [(name, sections[name], fields) for name, (_, fields) in SECTIONS.items() if name in sections]
+
+
+@lru_cache
+def part_schema(fields: tuple[str, ...]) -> dict:
+    """JSON schema of a model with only these Report fields, with their types and descriptions."""
+    model = create_model(
+        "Report",
+        **{name: (Report.model_fields[name].annotation, Report.model_fields[name]) for name in fields},
+    )
+    return model.model_json_schema()
+
+
+def merge_parts(outputs: list[tuple[list[str], str]]) -> str:
+    """
+    Merge the (fields, output text) of the parts of a report into one JSON object with every
+    Report field. Fields missing from an output, or outputs that cannot be parsed, are null.
+    """
+    merged = {name: None for name in Report.model_fields}
+
+    for fields, text in outputs:
+        data, _ = parse_json(text)
+
+        if not isinstance(data, dict):
+            continue
+
+        for name in fields:
+            merged[name] = data.get(name)
+
+    return json.dumps(merged, indent=2)
+
+
+def section_spec() -> dict:
+    """What determines how reports are split, for the configuration hash of extract_tabular.py."""
+    # the fields of missing sections used to be asked for with the whole report
+    return {"sections": {name: list(spec) for name, spec in SECTIONS.items()}, "missing": "null"}
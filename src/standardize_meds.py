@@ -2,20 +2,166 @@ import sys
 
 sys.path.append("../src")
 
+import argparse
 from pathlib import Path
 from tqdm import tqdm
 import polars as pl
 
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
-from ratelimit import limits, sleep_and_retry
+from requests.adapters import HTTPAdapter
 
+from config import config
+
+# Settings are in config.yaml (rxnorm)
+settings = config.rxnorm
+
+# Every lookup is stored here, keyed on the normalized search term, and reused by later runs.
+cache_path = Path(settings.cache)
+# Entries older than this are looked up again. None to keep them forever.
+cache_ttl_days = settings.cache_ttl_days
+# Never touch the network, terms missing from the cache map to no ingredients
+offline = settings.offline
+# Optional JSON file {search term: [ingredients]} loaded into the cache before the run
+cache_seed_path = settings.cache_seed
+
+# rrf/ folder of an RxNorm release. If set, terms are resolved with a local fuzzy index
+# (rxnorm_index.py) instead of the RxNav API: no network, no rate limit.
+rxnorm_release_path = settings.release_dir
+rxnorm_index_path = Path(settings.index)
+
+# Point this to stub_rxnav_server.py to run against canned responses
+rxnav_url = settings.rxnav_url
+max_calls_per_second = settings.max_calls_per_second  # RxNorm has a limit of 20 calls per second
+n_threads = settings.n_threads
+max_retries = settings.max_retries
+backoff_seconds = settings.backoff_seconds
+
+
+def normalize_term(search_term: str) -> str:
+    """Cache key of a search term: lowercase with whitespace collapsed, so "Aspirin  81mg" == "aspirin 81mg"."""
+    return " ".join(search_term.lower().split())
+
+
+class RxNormCache:
+    """Persistent SQLite cache of search term -> list of standardized ingredient names."""
+
+    def __init__(self, path: Path, ttl_days: float | None = None):
+        self.ttl = None if ttl_days is None else ttl_days * 86400
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS rxnorm (term TEXT PRIMARY KEY, ingredients TEXT, fetched REAL)"
+        )
+
+    def get(self, search_term: str) -> list | None:
+        """Cached ingredients, or None if the term was never looked up or its entry expired."""
+        row = self.conn.execute(
+            "SELECT ingredients, fetched FROM rxnorm WHERE term = ?", (normalize_term(search_term),)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        ingredients, fetched = row
+
+        if self.ttl is not None and time.time() - fetched > self.ttl:
+            return None
+
+        return json.loads(ingredients)
+
+    def put(self, search_term: str, ingredients: list):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO rxnorm VALUES (?, ?, ?)",
+            (normalize_term(search_term), json.dumps(ingredients), time.time()),
+        )
+        self.conn.commit()
+
+    def seed(self, mapping: dict[str, list]):
+        """Pre-fill the cache, e.g. with a known mapping so that tests can run offline."""
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO rxnorm VALUES (?, ?, ?)",
+            [(normalize_term(term), json.dumps(ingredients), now) for term, ingredients in mapping.items()],
+        )
+        self.conn.commit()
+
+    def invalidate(self, search_terms: list[str] | None = None):
+        """Drop the given terms from the cache, or every entry if none are given."""
+        if search_terms is None:
+            self.conn.execute("DELETE FROM rxnorm")
+        else:
+            self.conn.executemany(
+                "DELETE FROM rxnorm WHERE term = ?", [(normalize_term(term),) for term in search_terms]
+            )
+        self.conn.commit()
 
-@sleep_and_retry
-@limits(calls=20, period=1)  # RxNorm has a limit of 20 calls per second
-def standardize_drug_name(search_term: str) -> list:
-    approx_url = "https://rxnav.nlm.nih.gov/REST/approximateTerm.json"
-    related_url = "https://rxnav.nlm.nih.gov/REST/rxcui/{rxcui}/related.json"
 
+class RateLimiter:
+    """
+    Thread-safe limiter that hands out one call every 1/rate seconds, so that all
+    threads together stay exactly at the API ceiling without bursting above it.
+    """
+
+    def __init__(self, calls_per_second: float):
+        self.interval = 1 / calls_per_second
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+
+        time.sleep(max(0, slot - now))
+
+
+# shared by all threads: connections are kept alive and reused instead of
+# opening a new TCP/TLS connection for every call
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=n_threads))
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=n_threads))
+
+rate_limiter = RateLimiter(max_calls_per_second)
+
+
+def retry_delay(retry_after: str | None, attempt: int) -> float:
+    """Seconds to wait before retrying: Retry-After if it is a number of seconds, otherwise exponential backoff."""
+    try:
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        # missing, or an HTTP date
+        return backoff_seconds * 2**attempt
+
+
+def rxnav_get(path: str, params: dict) -> dict:
+    """GET an RxNav endpoint within the rate limit, retrying with exponential backoff on 429, 5xx and connection errors."""
+    for attempt in range(max_retries + 1):
+        rate_limiter.wait()
+
+        try:
+            resp = session.get(rxnav_url + path, params=params, timeout=30)
+        except requests.ConnectionError:
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff_seconds * 2**attempt)
+            continue
+
+        if (resp.status_code == 429 or resp.status_code >= 500) and attempt < max_retries:
+            time.sleep(retry_delay(resp.headers.get("Retry-After"), attempt))
+            continue
+
+        resp.raise_for_status()
+
+        return resp.json()
+
+
+def standardize_drug_name(search_term: str) -> list:
     params = {
         "format": ".json",
         "term": search_term,
@@ -23,11 +169,8 @@ def standardize_drug_name(search_term: str) -> list:
         "maxEntries": 1,  # do not return more than these many approximate matches, it may return fewer
     }
 
-    resp = requests.get(approx_url, params=params)
-    resp.raise_for_status()
-
     candidates = (
-        resp.json().get("approximateGroup").get("candidate")
+        rxnav_get("/approximateTerm.json", params).get("approximateGroup").get("candidate")
     )  # This is always a list, even for a single best match
 
     if candidates is None:
@@ -35,33 +178,119 @@ def standardize_drug_name(search_term: str) -> list:
 
     rxcui = candidates[0]["rxcui"]  # get the top candidate
 
-    related = requests.get(related_url.format(rxcui=rxcui), params={"tty": ["IN"]})
-    related.raise_for_status()
+    related = rxnav_get(f"/rxcui/{rxcui}/related.json", {"tty": ["IN"]})
 
     # this is always an ingredient, so the name is the standardized ingredient name
     # it may be a list of ingredients for a multi-ingredient drug
-    ingredients = (
-        related.json()
-        .get("relatedGroup")
-        .get("conceptGroup")[0]
-        .get("conceptProperties")
-    )
+    concept_groups = (related.get("relatedGroup") or {}).get("conceptGroup")
+
+    # no related ingredient at all
+    if not concept_groups:
+        return []
+
+    ingredients = concept_groups[0].get("conceptProperties")
 
     if ingredients is None:
         return []
     else:
         ingredient_names = [ingredient["name"] for ingredient in ingredients if ingredient is not None]
 
-    print(search_term)
-    print(ingredient_names)
-    print()
-
     return ingredient_names
 
 
+def lookup_terms(search_terms, cache: RxNormCache, offline: bool = False) -> dict[str, list]:
+    """
+    Standardize each distinct normalized term once: from the cache when possible,
+    otherwise from RxNav (unless offline), storing the answer in the cache.
+    Returns {normalized term: ingredients}.
+    """
+    terms = {normalize_term(term) for term in search_terms}
+
+    results = {}
+    missing = []
+
+    for term in terms:
+        ingredients = cache.get(term)
+
+        if ingredients is None:
+            missing.append(term)
+        else:
+            results[term] = ingredients
+
+    print(f"{len(terms)} distinct terms, {len(results)} cached, {len(missing)} to look up")
+
+    if offline:
+        for term in missing:
+            results[term] = []
+        return results
+
+    # Each thread runs approximateTerm -> related for its own term, so the second call of
+    # one term overlaps with the first call of others and the rate limit is always saturated.
+    # The cache is only written from this thread, sqlite connections cannot be shared.
+    with ThreadPoolExecutor(n_threads) as pool:
+        futures = {pool.submit(standardize_drug_name, term): term for term in missing}
+
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            term = futures[future]
+
+            try:
+                results[term] = future.result()
+            except requests.RequestException as e:
+                # not cached, it will be looked up again on the next run
+                print(f"{term}: lookup failed, {e}")
+                results[term] = []
+                continue
+
+            cache.put(term, results[term])
+
+    return results
+
+
+def load_local_index():
+    """Load the local RxNorm index, building it from the release the first time."""
+    from rxnorm_index import RxNormIndex
+
+    if rxnorm_index_path.exists():
+        return RxNormIndex.load(rxnorm_index_path)
+
+    index = RxNormIndex.build(Path(rxnorm_release_path))
+    index.save(rxnorm_index_path)
+
+    return index
+
+
+def standardize_drug_names(search_terms) -> dict[str, list]:
+    """
+    {search term: ingredients} for many terms at once, e.g. a column of drug names.
+    Uses the local index if rxnorm_release_path is set, otherwise the cached RxNav lookup.
+    Null terms are left out.
+    """
+    search_terms = [term for term in search_terms if term is not None]
+
+    if rxnorm_release_path is not None:
+        return load_local_index().lookup_many(search_terms)
+
+    standardized = lookup_terms(search_terms, RxNormCache(cache_path, cache_ttl_days), offline)
+
+    return {term: standardized[normalize_term(term)] for term in search_terms}
+
+
 def main():
-    base_path = Path("/projectnb/vkolagrp/bellitti/clinicalnotes-databasing-validated")
-    tabular_path = base_path / "results/NBSE_tabulated.parquet"
+    parser = argparse.ArgumentParser(description="Map the extracted medications to RxNorm ingredients")
+    parser.add_argument(
+        "--invalidate",
+        nargs="*",
+        metavar="TERM",
+        help="drop these search terms (every entry if none are given) from the cache before the run, so they are looked up again",
+    )
+    args = parser.parse_args()
+
+    if args.invalidate is not None:
+        cache = RxNormCache(cache_path, cache_ttl_days)
+        cache.invalidate(args.invalidate or None)
+        print(f"Dropped {f'{len(args.invalidate)} terms' if args.invalidate else 'every entry'} from the cache")
+
+    tabular_path = Path(config.paths.tabulated)
 
     tabular = (
         pl.read_parquet(tabular_path)
@@ -69,13 +298,30 @@ def main():
         .explode("medications")
     )
 
-    df = tabular.with_columns(
-            pl.col("medications")
-            .map_elements(standardize_drug_name, return_dtype=pl.List(pl.String))
-            .alias("standard_ingredient")
-        ).rename({'medications':'medication'}).explode('standard_ingredient')
+    if cache_seed_path is not None:
+        with open(cache_seed_path) as f:
+            RxNormCache(cache_path, cache_ttl_days).seed(json.load(f))
+
+    medications = tabular["medications"].drop_nulls().unique().to_list()
+
+    standardized = standardize_drug_names(medications)
+
+    # one row per distinct medication string, joined back onto every row that mentions it
+    mapping = pl.DataFrame(
+        {
+            "medications": medications,
+            "standard_ingredient": [standardized[m] for m in medications],
+        },
+        schema={"medications": pl.String, "standard_ingredient": pl.List(pl.String)},
+    )
+
+    df = (
+        tabular.join(mapping, on="medications", how="left")
+        .rename({"medications": "medication"})
+        .explode("standard_ingredient")
+    )
 
-    df.write_parquet(base_path / "results/medications_tabulated.parquet")
+    df.write_parquet(config.paths.medications)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+# Minimal stand-in for an OpenAI-compatible server (vllm serve), to run
+# extract_tabular.py in server mode without a GPU.
+#
+# Every chat completion request gets the same canned JSON as the answer: the content of
+# the file given on the command line, or a Report with every field set to null. Streamed
+# requests get it in a few chunks per choice, then the usage if asked for.
+#
+#   python src/stub_openai_server.py [canned.json] [--port 8000] [--delay 0.1]
+
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from nbse_report_schema_minimal import Report
+
+
+def make_handler(content: str, delay: float):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+
+            time.sleep(delay)  # pretend to generate
+
+            if request.get("stream"):
+                self.stream(request)
+                return
+
+            body = json.dumps({
+                "id": "stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [
+                    {
+                        "index": i,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                    for i in range(request.get("n", 1))
+                ],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }).encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def stream(self, request: dict):
+            """Server-sent events like vllm serve, the connection is closed at the end."""
+            n = request.get("n", 1)
+            step = max(1, len(content) // 4)
+
+            def chunk(choices: list[dict], usage: dict | None = None) -> bytes:
+                data = {
+                    "id": "stub",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": request.get("model", "stub"),
+                    "choices": choices,
+                    "usage": usage,
+                }
+                return f"data: {json.dumps(data)}\n\n".encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+
+            for i in range(n):
+                for start in range(0, len(content), step):
+                    delta = {"content": content[start:start + step]}
+                    self.wfile.write(chunk([{"index": i, "delta": delta, "finish_reason": None}]))
+                self.wfile.write(chunk([{"index": i, "delta": {}, "finish_reason": "stop"}]))
+
+            if (request.get("stream_options") or {}).get("include_usage"):
+                self.wfile.write(chunk([], {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}))
+
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("canned", nargs="?", help="JSON file returned as the completion")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before answering")
+    args = parser.parse_args()
+
+    if args.canned:
+        with open(args.canned) as f:
+            content = f.read()
+    else:
+        content = json.dumps({name: None for name in Report.model_fields})
+
+    server = ThreadingHTTPServer(("localhost", args.port), make_handler(content, args.delay))
+    print(f"Stub server listening on http://localhost:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
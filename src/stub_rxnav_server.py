@@ -0,0 +1,91 @@
+# Minimal stand-in for the RxNav REST API, to run standardize_meds.py without
+# hitting rxnav.nlm.nih.gov. Set rxnorm.rxnav_url: http://localhost:8001/REST in config.yaml.
+#
+# Responses are replayed from a JSON file of canned RxNav answers:
+#   {
+#     "approximateTerm": {"<search term>": <approximateTerm.json response>, ...},
+#     "related": {"<rxcui>": <related.json response>, ...}
+#   }
+# Unknown terms get an empty candidate list. With --error-rate a fraction of requests
+# answer 429, and with --fail-first the first requests do, to exercise the retries. The
+# Retry-After header of those answers is --retry-after, seconds or an HTTP date.
+#
+#   python src/stub_rxnav_server.py canned_rxnav.json [--port 8001] [--error-rate 0.1] [--fail-first 3]
+
+import argparse
+import json
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def make_handler(canned: dict, error_rate: float, fail_first: int = 0, retry_after: str = "0"):
+    # requests answered so far, for fail_first
+    count = {"n": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            with lock:
+                count["n"] += 1
+                early = count["n"] <= fail_first
+
+            if early or random.random() < error_rate:
+                self.send_response(429)
+                self.send_header("Retry-After", retry_after)
+                self.end_headers()
+                return
+
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+
+            related = re.fullmatch(r"/REST/rxcui/(\w+)/related.json", url.path)
+
+            if url.path == "/REST/approximateTerm.json":
+                term = query.get("term", [""])[0]
+                body = canned["approximateTerm"].get(term, {"approximateGroup": {"candidate": None}})
+            elif related:
+                body = canned["related"].get(
+                    related.group(1), {"relatedGroup": {"conceptGroup": [{"tty": "IN"}]}}
+                )
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            data = json.dumps(body).encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("canned", help="JSON file of canned RxNav responses")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--fail-first", type=int, default=0, help="answer this many first requests with 429")
+    parser.add_argument("--retry-after", default="0", help="Retry-After header of the 429 answers")
+    args = parser.parse_args()
+
+    with open(args.canned) as f:
+        canned = json.load(f)
+
+    server = ThreadingHTTPServer(("localhost", args.port), make_handler(canned, args.error_rate, args.fail_first, args.retry_after))
+    print(f"Stub RxNav server listening on http://localhost:{args.port}/REST")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
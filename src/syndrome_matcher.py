@@ -0,0 +1,214 @@
+# Normalize the free-text clinical_syndrome and diagnosis columns of NBSE_tabulated.parquet
+# to the codes of a reference list of synonyms (data/specific_syndromes_reference.json,
+# data/clinical_diagnoses.json), as first done in notebooks/specific_clinical_syndrome.ipynb.
+#
+# Each distinct string is cleaned and lemmatized once, in batches with nlp.pipe. As in the
+# notebook, the TF-IDF vectorizer is fitted on the references and the strings together, so
+# J and the min_jaccard threshold are the notebook's. The scores of all strings against all
+# references are computed together with matrix operations:
+#   J       weighted Jaccard index of the TF-IDF vectors, what the notebook used to match
+#   jaccard Jaccard index of the sets of n-grams, ignoring weights
+#   cosine  cosine similarity of the TF-IDF vectors
+
+import json
+import re
+import string
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from config import config
+
+base_path = Path(config.base_path)
+
+syndrome_reference_path = base_path / "data/specific_syndromes_reference.json"
+diagnosis_reference_path = base_path / "data/clinical_diagnoses.json"
+
+# below this weighted Jaccard index the string does not match any reference
+min_jaccard = 0.1
+
+# strings that name a diagnosis rather than a specific syndrome
+remove_from_syndrome = [
+    "amnestic mci",
+    "amnesic mci",
+    "mild dementia",
+    "mild cognitive impairment",
+    "amnestic mild cognitive impairment",
+    "non amnestic mild cognitive impairment",
+    "non amnestic mci",
+    "subjective cognitive decline",
+    "mci amnestic subtype",
+    "dementia",
+]
+
+PUNCTUATION = str.maketrans(string.punctuation, " " * len(string.punctuation))
+
+# cleaned string -> lemmatized string, shared by every matcher
+lemma_cache = {}
+
+
+@lru_cache(maxsize=1)
+def get_nlp():
+    import spacy
+
+    # only the lemmatizer (and the tagger it needs) is used
+    return spacy.load("en_core_web_lg", disable=["parser", "ner"])
+
+
+def strip_punctuation(text: str) -> str:
+    """Lowercase, with punctuation replaced by spaces and whitespace collapsed."""
+    return re.sub(r"\s+", " ", text.lower().translate(PUNCTUATION)).strip()
+
+
+def clean_many(texts: list[str], batch_size: int = 256) -> list[str]:
+    """Lowercase, strip punctuation and lemmatize, running spaCy only on strings not seen before."""
+    cleaned = [strip_punctuation(text) for text in texts]
+
+    new = list(dict.fromkeys(text for text in cleaned if text not in lemma_cache))
+
+    if new:
+        for text, doc in zip(new, get_nlp().pipe(new, batch_size=batch_size)):
+            lemma_cache[text] = " ".join(token.lemma_ for token in doc)
+
+    return [lemma_cache[text] for text in cleaned]
+
+
+class ReferenceMatcher:
+    """Match strings to the closest synonym of a {synonym: code} reference dictionary."""
+
+    def __init__(self, references: dict[str, str], max_ngram: int = 2):
+        self.ref_texts = list(references.keys())
+        self.codes = [references[r] for r in self.ref_texts]
+        self.ref_clean = clean_many(self.ref_texts)
+        self.max_ngram = max_ngram
+
+    @staticmethod
+    def min_sums(sent_vecs, ref_vecs, block_size: int = 2**24):
+        """
+        Sum of min(a, b) over the n-grams, for every pair of sentence and reference vectors.
+        Only n-grams found in both sets can contribute, so this is a dense block over those
+        columns, computed block_size entries at a time to bound the memory.
+        """
+        shared = np.intersect1d(sent_vecs.indices, ref_vecs.indices)
+        sent_dense = sent_vecs[:, shared].toarray()
+        ref_dense = ref_vecs[:, shared].toarray()
+
+        mins = np.zeros((sent_vecs.shape[0], ref_vecs.shape[0]))
+        step = max(1, block_size // max(1, ref_dense.size))
+
+        for start in range(0, len(sent_dense), step):
+            block = sent_dense[start : start + step, None, :]
+            mins[start : start + step] = np.minimum(block, ref_dense[None, :, :]).sum(axis=2)
+
+        return mins
+
+    def scores(self, sent_vecs, ref_vecs):
+        """Weighted Jaccard, Jaccard and cosine of every sentence against every reference."""
+        sent_vecs = sent_vecs.tocsr()
+        ref_vecs = ref_vecs.tocsr()
+
+        # the vectors are l2-normalized, so this is the cosine similarity
+        cosine = (sent_vecs @ ref_vecs.T).toarray()
+
+        # sizes of the intersections of the sets of n-grams, for all pairs at once
+        sent_bin = sent_vecs.copy()
+        sent_bin.data[:] = 1
+        ref_bin = ref_vecs.copy()
+        ref_bin.data[:] = 1
+        inter = (sent_bin @ ref_bin.T).toarray()
+        union = np.diff(sent_vecs.indptr)[:, None] + np.diff(ref_vecs.indptr)[None, :] - inter
+        jaccard = np.divide(inter, union, out=np.zeros_like(cosine), where=union > 0)
+
+        # sum of max(a, b) = sum of a + sum of b - sum of min(a, b)
+        mins = self.min_sums(sent_vecs, ref_vecs)
+        maxs = np.asarray(sent_vecs.sum(axis=1)) + np.asarray(ref_vecs.sum(axis=1)).T - mins
+        weighted = np.divide(mins, maxs, out=np.zeros_like(cosine), where=maxs > 0)
+
+        return weighted, jaccard, cosine
+
+    def match(self, sentences: list[str]) -> pl.DataFrame:
+        """One row per sentence with its best reference by weighted Jaccard index."""
+        unique = list(dict.fromkeys(sentences))
+        sent_clean = clean_many(unique)
+
+        # unigrams up to max_ngram, so it's not just bag-of-words
+        vectorizer = TfidfVectorizer(ngram_range=(1, self.max_ngram))
+        tfidf = vectorizer.fit_transform(self.ref_clean + sent_clean).tocsr()
+        n_refs = len(self.ref_clean)
+
+        weighted, jaccard, cosine = self.scores(tfidf[n_refs:], tfidf[:n_refs])
+
+        rows = np.arange(len(unique))
+        best = weighted.argmax(axis=1) if len(unique) else np.zeros(0, dtype=int)
+
+        matches = pl.DataFrame(
+            {
+                "sentence": unique,
+                "sent_clean": sent_clean,
+                "J": weighted[rows, best],
+                "jaccard": jaccard[rows, best],
+                "cosine": cosine[rows, best],
+                "best_match": [self.ref_texts[i] for i in best],
+                "code": [self.codes[i] for i in best],
+            },
+            schema_overrides={"sentence": pl.String, "sent_clean": pl.String, "best_match": pl.String, "code": pl.String},
+        )
+
+        return pl.DataFrame({"sentence": sentences}, schema={"sentence": pl.String}).join(
+            matches, on="sentence", how="left", maintain_order="left"
+        )
+
+
+@lru_cache
+def load_matcher(reference_path: Path, max_ngram: int) -> ReferenceMatcher:
+    """Matcher for a reference file, with the references lemmatized once per process."""
+    with open(reference_path) as f:
+        return ReferenceMatcher(json.load(f), max_ngram)
+
+
+def normalize_syndromes(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Add syndrome_code and diagnosis_code columns to a frame with VAC, clinical_syndrome and
+    diagnosis columns. Null inputs and weak matches (J < min_jaccard) get a null code.
+    """
+    syndromes = df["clinical_syndrome"].str.to_lowercase().drop_nulls().unique().to_list()
+    diagnoses = df["diagnosis"].drop_nulls().unique().to_list()
+
+    syndrome_matches = load_matcher(syndrome_reference_path, 2).match(syndromes).select(
+        pl.col("sentence").alias("syndrome_key"),
+        pl.when(pl.col("J") < min_jaccard)
+        .then(None)
+        .when(pl.col("sent_clean").is_in(remove_from_syndrome))
+        .then(None)
+        .otherwise(pl.col("code"))
+        .alias("syndrome_code"),
+        pl.col("J").alias("syndrome_J"),
+    )
+
+    diagnosis_matches = load_matcher(diagnosis_reference_path, 3).match(diagnoses).select(
+        pl.col("sentence").alias("diagnosis"),
+        pl.when(pl.col("J") < min_jaccard).then(None).otherwise(pl.col("code")).alias("diagnosis_code"),
+        pl.col("J").alias("diagnosis_J"),
+    )
+
+    return (
+        df.with_columns(pl.col("clinical_syndrome").str.to_lowercase().alias("syndrome_key"))
+        .join(syndrome_matches, on="syndrome_key", how="left", maintain_order="left")
+        .join(diagnosis_matches, on="diagnosis", how="left", maintain_order="left")
+        .drop("syndrome_key")
+    )
+
+
+def main():
+    tabular = pl.read_parquet(config.paths.tabulated).select(
+        "VAC", "diagnosis", "clinical_syndrome"
+    )
+
+    normalize_syndromes(tabular).write_parquet(config.paths.syndromes)
+
+
+if __name__ == "__main__":
+    main()
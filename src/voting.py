@@ -0,0 +1,67 @@
+# Self-consistency: several samples of the same prompt, combined field by field by
+# majority vote (extraction.samples in config.yaml).
+#
+# Every sample is parsed and validated against Report like json_to_tabular.py does, so an
+# invalid value counts as a vote for null. The agreement of a field is the fraction of the
+# samples that voted for the winning value, samples that could not be parsed included: 1.0
+# means every sample gave the same value. Ties go to the value of the earliest sample.
+#
+# Sampling is cost-aware: extract_tabular.py first draws extraction.first_samples samples of
+# every prompt, and only draws the others for the prompts whose samples do not all agree.
+
+import json
+from collections import Counter
+
+from json_to_tabular import parse_json, validate_and_clean_data
+from nbse_report_schema_minimal import Report
+
+
+def validated_samples(texts: list[str]) -> list[dict]:
+    """The samples that can be parsed, with the invalid values set to null."""
+    samples = []
+
+    for text in texts:
+        data, _ = parse_json(text)
+
+        if not isinstance(data, dict):
+            continue
+
+        # missing fields are null too, the log lines are not needed
+        samples.append(validate_and_clean_data(data, Report, log=[]).model_dump(mode="json"))
+
+    return samples
+
+
+def vote(texts: list[str], fields: list[str]) -> tuple[dict, dict[str, float]]:
+    """The majority value of each field over the samples, and its agreement."""
+    samples = validated_samples(texts)
+
+    values = {}
+    agreement = {}
+
+    for field in fields:
+        votes = Counter(json.dumps(sample[field], sort_keys=True) for sample in samples)
+
+        if not votes:
+            values[field] = None
+            agreement[field] = 0.0
+            continue
+
+        # most_common keeps the order of first appearance among equal counts
+        winner, count = votes.most_common(1)[0]
+        values[field] = json.loads(winner)
+        agreement[field] = count / len(texts)
+
+    return values, agreement
+
+
+def unanimous(agreement: dict[str, float]) -> bool:
+    """Whether every sample parsed and gave the same value for every field."""
+    return all(a == 1.0 for a in agreement.values())
+
+
+def add_agreement(merged: str, agreement: dict[str, float], n_samples: dict[str, int]) -> str:
+    """Record the agreement of every field and the samples drawn per part under "_meta" of a merged output."""
+    data = json.loads(merged)
+    data.setdefault("_meta", {}).update(agreement=agreement, samples=n_samples)
+    return json.dumps(data, indent=2)
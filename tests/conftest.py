@@ -0,0 +1,141 @@
+# CPU-only regression tests of the extraction pipeline, with the replay backend and the stub
+# servers instead of a GPU, a model or the network. Every script reads config.yaml when it is
+# imported, so the tests run them in subprocesses with NBSE_CONFIG pointing to a config of
+# a temporary project.
+#
+#   uv run --with pytest pytest tests
+
+import hashlib
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from omegaconf import OmegaConf
+
+src_dir = Path(__file__).resolve().parents[1] / "src"
+
+REPORT = """VAC_{vac}
+Age: 78
+Sex: male
+
+MoCA: 24/30
+
+Medications
+aspirin 81 mg
+
+Summary
+Mild cognitive impairment, amnestic.
+"""
+
+# reports of both shards when the corpus is split in two (see extract_tabular.shard_of)
+VACS = [1, 2, 3, 4, 5, 6]
+
+
+def shard_of(vac: int, n_shards: int) -> int:
+    digest = hashlib.sha256(str(vac).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % n_shards
+
+
+class Project:
+    """A temporary copy of the project layout, with its own config overlay."""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.txt_dir = root / "txt"
+        self.extracted_dir = root / "extracted"
+        self.config_path = root / "config.yaml"
+        self.settings = {
+            "base_path": str(root),
+            "paths": {
+                "txt_dir": str(self.txt_dir),
+                "extracted_dir": str(self.extracted_dir),
+                "logs_dir": str(root / "logs"),
+                "metrics_dir": str(root / "logs" / "metrics"),
+                "tabulated": str(root / "results" / "NBSE_tabulated.parquet"),
+                "medications": str(root / "results" / "medications_tabulated.parquet"),
+                "stream_output": str(root / "results" / "NBSE_tabulated_stream.jsonl"),
+            },
+            "extraction": {"backend": "replay"},
+            "rxnorm": {"cache": str(root / "results" / "rxnorm_cache.sqlite")},
+        }
+
+        self.txt_dir.mkdir(parents=True)
+        (root / "logs").mkdir()
+        (root / "results").mkdir()
+
+        for vac in VACS:
+            (self.txt_dir / f"VAC_{vac}_report.txt").write_text(REPORT.format(vac=vac), encoding="utf-8")
+
+    def configure(self, **sections):
+        """Update sections of the config overlay, e.g. configure(extraction={"mode": "server"})."""
+        for name, values in sections.items():
+            self.settings.setdefault(name, {}).update(values)
+
+    def run(self, script: str, *args, env: dict | None = None, check: bool = True) -> subprocess.CompletedProcess:
+        """Run a script of src/ on this project, returning its output."""
+        OmegaConf.save(OmegaConf.create(self.settings), self.config_path)
+
+        run_env = dict(os.environ, NBSE_CONFIG=str(self.config_path), PYTHONPATH=str(src_dir))
+        run_env.pop("SGE_TASK_ID", None)
+        run_env.update(env or {})
+
+        result = subprocess.run(
+            [sys.executable, str(src_dir / script), *args],
+            env=run_env,
+            cwd=self.root,
+            capture_output=True,
+            text=True,
+        )
+
+        if check and result.returncode != 0:
+            raise AssertionError(f"{script} failed:\n{result.stdout}\n{result.stderr}")
+
+        return result
+
+
+@pytest.fixture
+def project(tmp_path) -> Project:
+    assert {shard_of(vac, 2) for vac in VACS} == {0, 1}
+    return Project(tmp_path)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def start_server():
+    """Start a stub server script of src/ on a free port, returning the port. Stopped at the end of the test."""
+    processes = []
+
+    def start(script: str, *args) -> int:
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, str(src_dir / script), *args, "--port", str(port)],
+            env=dict(os.environ, PYTHONPATH=str(src_dir)),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        processes.append(process)
+
+        # wait until it accepts connections
+        for _ in range(100):
+            try:
+                socket.create_connection(("localhost", port), timeout=0.1).close()
+                return port
+            except OSError:
+                time.sleep(0.1)
+
+        raise RuntimeError(f"{script} did not start")
+
+    yield start
+
+    for process in processes:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,60 @@
+import json
+
+import polars as pl
+
+from conftest import VACS, shard_of
+
+
+def read_manifest(path) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_replay_extraction_resumes(project):
+    first = project.run("extract_tabular.py")
+    assert f"{len(VACS)} to extract" in first.stdout
+
+    batches = sorted((project.extracted_dir / "outputs").glob("*.parquet"))
+    assert batches
+    assert len(read_manifest(project.extracted_dir / "manifest.jsonl")) == len(VACS)
+
+    # everything is in the manifest and the outputs dataset, nothing to do
+    second = project.run("extract_tabular.py")
+    assert f"0 to extract, {len(VACS)} already extracted" in second.stdout
+    assert sorted((project.extracted_dir / "outputs").glob("*.parquet")) == batches
+
+    # a changed report is extracted again, and only that one
+    report = project.txt_dir / "VAC_1_report.txt"
+    report.write_text(report.read_text(encoding="utf-8") + "Education: 16 years\n", encoding="utf-8")
+    third = project.run("extract_tabular.py")
+    assert "1 to extract" in third.stdout
+
+
+def test_tabulation(project):
+    project.run("extract_tabular.py")
+    project.run("json_to_tabular.py")
+
+    tabulated = pl.read_parquet(project.settings["paths"]["tabulated"])
+
+    assert sorted(tabulated["VAC"]) == VACS
+    # the replay backend has no recordings, so every field is null
+    assert tabulated["moca_total_score"].null_count() == len(VACS)
+
+
+def test_merge_shards_detects_missing_shard(project):
+    shard_env = {"SGE_TASK_ID": "1", "NUM_SHARDS": "2"}
+    project.run("extract_tabular.py", env=shard_env)
+
+    incomplete = project.run("merge_shards.py", check=False)
+    assert incomplete.returncode == 1
+
+    n_missing = sum(shard_of(vac, 2) == 1 for vac in VACS)
+    assert f"missing: {n_missing}" in incomplete.stdout
+    # nothing is merged until every shard is there
+    assert not (project.extracted_dir / "manifest.jsonl").exists()
+
+    project.run("extract_tabular.py", env=shard_env | {"SGE_TASK_ID": "2"})
+    project.run("merge_shards.py")
+
+    assert len(read_manifest(project.extracted_dir / "manifest.jsonl")) == len(VACS)
+    assert not list(project.extracted_dir.glob("manifest.shard*.jsonl"))
@@ -0,0 +1,59 @@
+import json
+
+import polars as pl
+
+from conftest import VACS
+
+CANNED_RXNAV = {
+    "approximateTerm": {
+        "aspirin 81 mg": {"approximateGroup": {"candidate": [{"rxcui": "243670"}]}},
+    },
+    "related": {
+        "243670": {"relatedGroup": {"conceptGroup": [{"tty": "IN", "conceptProperties": [{"name": "aspirin"}]}]}},
+    },
+}
+
+
+def test_server_mode_against_stub(project, start_server):
+    port = start_server("stub_openai_server.py")
+    project.configure(extraction={"mode": "server", "server_url": f"http://localhost:{port}/v1"})
+
+    project.run("extract_tabular.py")
+    project.run("extract_tabular.py")
+
+    stream_path = project.settings["paths"]["stream_output"]
+    with open(stream_path, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f]
+
+    # every report streamed once, and not again by the second run
+    assert sorted(row["VAC"] for row in rows) == VACS
+    assert len({row["filename"] for row in rows}) == len(VACS)
+
+    project.run("json_to_tabular.py")
+    assert pl.read_parquet(project.settings["paths"]["tabulated"]).height == len(VACS)
+
+
+def test_rxnav_lookup_retries_after_429(project, start_server):
+    canned_path = project.root / "canned_rxnav.json"
+    canned_path.write_text(json.dumps(CANNED_RXNAV), encoding="utf-8")
+
+    # the first requests are rate limited, with a Retry-After date rather than seconds
+    port = start_server(
+        "stub_rxnav_server.py", str(canned_path), "--fail-first", "3", "--retry-after", "Wed, 21 Oct 2015 07:28:00 GMT"
+    )
+    project.configure(
+        rxnorm={"rxnav_url": f"http://localhost:{port}/REST", "n_threads": 1, "max_retries": 5, "backoff_seconds": 0.01}
+    )
+
+    pl.DataFrame({"VAC": [1, 2], "medications": [["aspirin 81 mg", "unknownium"], None]}).write_parquet(
+        project.settings["paths"]["tabulated"]
+    )
+
+    project.run("standardize_meds.py")
+
+    medications = pl.read_parquet(project.settings["paths"]["medications"])
+    mapping = dict(medications.drop_nulls("medication").select("medication", "standard_ingredient").iter_rows())
+
+    assert mapping["aspirin 81 mg"] == "aspirin"
+    # no ingredient, a null row or no row at all depending on how the Polars version explodes []
+    assert mapping.get("unknownium") is None